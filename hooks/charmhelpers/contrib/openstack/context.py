@@ -13,6 +13,8 @@ from charmhelpers.fetch import (
     filter_installed_packages,
 )
 
+from charmhelpers.core.host import atomic_write
+
 from charmhelpers.core.hookenv import (
     config,
     local_unit,
@@ -69,11 +71,31 @@ def context_complete(ctxt):
 
 
 class OSContextGenerator(object):
+    '''
+    Generators return the template context for their interfaces without
+    changing anything on the unit.  Changes a context needs on the unit,
+    such as packages or files outside the rendered configs, are made by
+    apply, which the renderer calls with the generated context before it
+    writes a config file rendered with it; at most once per hook for the
+    same context.  apply should only act when its inputs changed.
+
+    Generators of the same class created with the same arguments share
+    their results within a hook, see templating.ContextCache.
+    '''
     interfaces = []
 
+    def __new__(cls, *args, **kwargs):
+        self = super(OSContextGenerator, cls).__new__(cls)
+        # recorded before __init__ or __call__ can change any attribute
+        self.init_args = (args, sorted(kwargs.iteritems()))
+        return self
+
     def __call__(self):
         raise NotImplementedError
 
+    def apply(self, ctxt):
+        pass
+
 
 class SharedDBContext(OSContextGenerator):
     interfaces = ['shared-db']
@@ -216,16 +238,17 @@ class CephContext(OSContextGenerator):
             'key': key,
         }
 
-        if not os.path.isdir('/etc/ceph'):
-            os.mkdir('/etc/ceph')
-
         if not context_complete(ctxt):
             return {}
 
-        ensure_packages(['ceph-common'])
-
         return ctxt
 
+    def apply(self, ctxt):
+        if not os.path.isdir('/etc/ceph'):
+            os.mkdir('/etc/ceph')
+        if ctxt:
+            ensure_packages(['ceph-common'])
+
 
 class HAProxyContext(OSContextGenerator):
     interfaces = ['cluster']
@@ -253,14 +276,15 @@ class HAProxyContext(OSContextGenerator):
             'units': cluster_hosts,
         }
         if len(cluster_hosts.keys()) > 1:
-            # Enable haproxy when we have enough peers.
-            log('Ensuring haproxy enabled in /etc/default/haproxy.')
-            with open('/etc/default/haproxy', 'w') as out:
-                out.write('ENABLED=1\n')
             return ctxt
         log('HAProxy context is incomplete, this unit has no peers.')
         return {}
 
+    def apply(self, ctxt):
+        # Enable haproxy when we have enough peers.
+        if ctxt and atomic_write('/etc/default/haproxy', 'ENABLED=1\n'):
+            log('Enabled haproxy in /etc/default/haproxy.')
+
 
 class ImageServiceContext(OSContextGenerator):
     interfaces = ['image-service']
@@ -307,24 +331,28 @@ class ApacheSSLContext(OSContextGenerator):
     service_namespace = None
 
     def enable_modules(self):
-        cmd = ['a2enmod', 'ssl', 'proxy', 'proxy_http']
-        check_call(cmd)
+        modules = [m for m in ['ssl', 'proxy', 'proxy_http']
+                   if not os.path.exists(os.path.join(
+                       '/etc/apache2/mods-enabled', '%s.load' % m))]
+        if modules:
+            check_call(['a2enmod'] + modules)
 
     def configure_cert(self):
+        '''
+        Writes the certificate, key and CA certificate, each only if its
+        content changed.  update-ca-certificates rescans the whole CA store,
+        so it only runs when the CA certificate changed.
+        '''
         if not os.path.isdir('/etc/apache2/ssl'):
             os.mkdir('/etc/apache2/ssl')
         ssl_dir = os.path.join('/etc/apache2/ssl/', self.service_namespace)
         if not os.path.isdir(ssl_dir):
             os.mkdir(ssl_dir)
         cert, key = get_cert()
-        with open(os.path.join(ssl_dir, 'cert'), 'w') as cert_out:
-            cert_out.write(b64decode(cert))
-        with open(os.path.join(ssl_dir, 'key'), 'w') as key_out:
-            key_out.write(b64decode(key))
+        atomic_write(os.path.join(ssl_dir, 'cert'), b64decode(cert))
+        atomic_write(os.path.join(ssl_dir, 'key'), b64decode(key))
         ca_cert = get_ca_cert()
-        if ca_cert:
-            with open(CA_CERT_PATH, 'w') as ca_out:
-                ca_out.write(b64decode(ca_cert))
+        if ca_cert and atomic_write(CA_CERT_PATH, b64decode(ca_cert)):
             check_call(['update-ca-certificates'])
 
     def __call__(self):
@@ -333,9 +361,6 @@ class ApacheSSLContext(OSContextGenerator):
         if (not self.external_ports or not https()):
             return {}
 
-        self.configure_cert()
-        self.enable_modules()
-
         ctxt = {
             'namespace': self.service_namespace,
             'private_address': unit_get('private-address'),
@@ -350,6 +375,11 @@ class ApacheSSLContext(OSContextGenerator):
             ctxt['endpoints'].append(portmap)
         return ctxt
 
+    def apply(self, ctxt):
+        if ctxt:
+            self.configure_cert()
+            self.enable_modules()
+
 
 class NeutronContext(object):
     interfaces = []
@@ -379,8 +409,7 @@ class NeutronContext(object):
             _file = '/etc/nova/quantum_plugin.conf'
         else:
             _file = '/etc/nova/neutron_plugin.conf'
-        with open(_file, 'wb') as out:
-            out.write(self.plugin + '\n')
+        atomic_write(_file, self.plugin + '\n')
 
     def ovs_ctxt(self):
         driver = neutron_plugin_attribute(self.plugin, 'driver',
@@ -413,8 +442,6 @@ class NeutronContext(object):
         return nvp_ctxt
 
     def __call__(self):
-        self._ensure_packages()
-
         if self.network_manager not in ['quantum', 'neutron']:
             return {}
 
@@ -428,9 +455,13 @@ class NeutronContext(object):
         elif self.plugin == 'nvp':
             ctxt.update(self.nvp_ctxt())
 
-        self._save_flag_file()
         return ctxt
 
+    def apply(self, ctxt):
+        self._ensure_packages()
+        if ctxt:
+            self._save_flag_file()
+
 
 class OSConfigFlagContext(OSContextGenerator):
         '''
@@ -1,26 +1,135 @@
 import os
+import imp
+import json
+import hashlib
+from collections import OrderedDict
 
 from charmhelpers.fetch import apt_install
 
+from charmhelpers.core import hookenv, metrics
+from charmhelpers.core.host import atomic_files, atomic_write
+
 from charmhelpers.core.hookenv import (
+    captured_log,
     log,
+    load_state,
+    save_state,
+    recording_relation_reads,
+    unit_state_dir,
     ERROR,
     INFO
 )
 
 from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
-try:
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
-except ImportError:
-    # python-jinja2 may not be installed yet, or we're running unittests.
-    FileSystemLoader = ChoiceLoader = Environment = exceptions = None
+# jinja2 is imported by _import_jinja2 when the first template is loaded;
+# python-jinja2 may not be installed yet, or we're running unittests.
+FileSystemLoader = ChoiceLoader = Environment = exceptions = None
+FileSystemBytecodeCache = None
+
+
+def _import_jinja2():
+    global FileSystemLoader, ChoiceLoader, Environment, exceptions
+    global FileSystemBytecodeCache
+    if Environment is None:
+        from jinja2 import (FileSystemLoader, ChoiceLoader, Environment,
+                            FileSystemBytecodeCache, exceptions)
+
+
+def _jinja2_installed():
+    try:
+        imp.find_module('jinja2')
+    except ImportError:
+        return False
+    return True
 
 
 class OSConfigException(Exception):
     pass
 
 
+class ContextCache(object):
+    """
+    Results of context generators, shared by all templates so that each
+    generator runs at most once per hook.  Results are keyed by generator
+    class and the arguments it was created with, or by the generator
+    itself if those are unknown, and dropped whenever hookenv flushes
+    cached relation data or config.
+
+    It also records the results each generator's side effects were last
+    applied for, see apply.
+    """
+    def __init__(self):
+        self.results = {}
+        self.applied = {}
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, context):
+        # not the generator's attributes, which __call__ may change
+        init_args = getattr(context, 'init_args', None)
+        if init_args is None:
+            return context
+        return (context.__class__, repr(init_args))
+
+    def _results(self):
+        if self.generation != hookenv.data_generation:
+            self.results.clear()
+            self.applied.clear()
+            self.generation = hookenv.data_generation
+        return self.results
+
+    def put(self, context, result):
+        self._results()[self.key(context)] = result
+
+    def __contains__(self, context):
+        return self.key(context) in self._results()
+
+    def __call__(self, context):
+        results = self._results()
+        key = self.key(context)
+        if key in results:
+            self.hits += 1
+        else:
+            self.misses += 1
+            results[key] = context()
+        return results[key]
+
+    def apply(self, context):
+        '''
+        Runs the apply method of context with its result, unless it was
+        already applied for the same result.
+        '''
+        apply = getattr(context, 'apply', None)
+        if apply is None:
+            return
+        result = self(context)
+        digest = hashlib.sha256(json.dumps(result, sort_keys=True,
+                                           default=str)).hexdigest()
+        key = self.key(context)
+        if self.applied.get(key) != digest:
+            apply(result)
+            self.applied[key] = digest
+
+
+context_cache = ContextCache()
+
+
+def _run_captured(context):
+    with captured_log() as messages:
+        result = context()
+    return result, messages
+
+
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -42,6 +151,7 @@ def get_loader(templates_dir, os_release):
                           jinja2.FilesystemLoaders, ordered in descending
                           order by OpenStack release.
     """
+    _import_jinja2()
     tmpl_dirs = [(rel, os.path.join(templates_dir, rel))
                  for rel in OPENSTACK_CODENAMES.itervalues()]
 
@@ -85,7 +195,7 @@ class OSConfigTemplate(object):
     def context(self):
         ctxt = {}
         for context in self.contexts:
-            _ctxt = context()
+            _ctxt = context_cache(context)
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -177,8 +287,13 @@ class OSConfigRenderer(object):
     of generators.  When a template is rendered and written, all context
     generates are called in a chain to generate the context dictionary
     passed to the jinja2 template. See context.py for more info.
+
+    Compiled templates are kept in a jinja2 bytecode cache in the unit's
+    state directory, one per OpenStack release.  With workers > 1,
+    write_all runs the context generators of all templates in a thread
+    pool before rendering, see write_all.
     """
-    def __init__(self, templates_dir, openstack_release):
+    def __init__(self, templates_dir, openstack_release, workers=1):
         if not os.path.isdir(templates_dir):
             log('Could not locate templates dir %s' % templates_dir,
                 level=ERROR)
@@ -186,10 +301,12 @@ class OSConfigRenderer(object):
 
         self.templates_dir = templates_dir
         self.openstack_release = openstack_release
-        self.templates = {}
+        self.workers = workers
+        # in registration order, which write_all follows
+        self.templates = OrderedDict()
         self._tmpl_env = None
 
-        if None in [Environment, ChoiceLoader, FileSystemLoader]:
+        if not _jinja2_installed():
             # if this code is running, the object is created pre-install hook.
             # jinja2 shouldn't get touched until the module is reloaded on next
             # hook execution, with proper jinja2 bits successfully imported.
@@ -198,16 +315,36 @@ class OSConfigRenderer(object):
     def register(self, config_file, contexts):
         """
         Register a config file with a list of context generators to be called
-        during rendering.
+        during rendering.  It is only written with atomic_write, which
+        records its changes for restart_on_change.
         """
         self.templates[config_file] = OSConfigTemplate(config_file=config_file,
                                                        contexts=contexts)
+        atomic_files.add(config_file)
         log('Registered config file: %s' % config_file, level=INFO)
 
+    def _bytecode_cache(self):
+        """
+        Returns a bytecode cache for the current release.  jinja2 keys the
+        cached bytecode by template name and path, and recompiles any
+        template whose source has changed.
+        """
+        cache_dir = os.path.join(unit_state_dir(), 'jinja2-cache',
+                                 self.openstack_release)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0700)
+        except OSError as e:
+            log('Not caching compiled templates: %s' % e, level=INFO)
+            return None
+        return FileSystemBytecodeCache(cache_dir)
+
     def _get_tmpl_env(self):
         if not self._tmpl_env:
+            _import_jinja2()
             loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            self._tmpl_env = Environment(loader=loader,
+                                         bytecode_cache=self._bytecode_cache())
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -240,27 +377,146 @@ class OSConfigRenderer(object):
         log('Rendering from template: %s' % _tmpl, level=INFO)
         return template.render(ctxt)
 
+    def _template_source(self, config_file):
+        """
+        Returns the source of the template render() uses for config_file,
+        without compiling it.
+        """
+        self._get_tmpl_env()
+        for _tmpl in [os.path.basename(config_file),
+                      '_'.join(config_file.split('/')[1:])]:
+            try:
+                return self._tmpl_env.loader.get_source(self._tmpl_env,
+                                                        _tmpl)[0]
+            except exceptions.TemplateNotFound:
+                continue
+        # render() logs and raises
+        return None
+
+    def render_digest(self, config_file):
+        """
+        Returns a digest of everything the rendered config_file depends on:
+        the template source, the OpenStack release and the context.
+        """
+        ctxt = self.templates[config_file].context()
+        return hashlib.sha256(json.dumps(
+            [self._template_source(config_file), self.openstack_release,
+             ctxt], sort_keys=True, default=str)).hexdigest()
+
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        Nothing is rendered or written if the render digest is the one saved
+        when the file was last written and the file is unchanged since.
+        The side effects of the file's context generators are applied
+        first either way.
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
 
-        _out = self.render(config_file)
+        for context in self.templates[config_file].contexts:
+            context_cache.apply(context)
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
+        digest = self.render_digest(config_file)
+        rendered = load_state('rendered-configs', {})
+        last = rendered.get(config_file, {})
+        if (last.get('digest') == digest and
+                last.get('content') == _file_digest(config_file)):
+            log('Template %s is up to date.' % config_file, level=INFO)
+            return
 
-        log('Wrote template %s.' % config_file, level=INFO)
+        _out = self.render(config_file)
+        if isinstance(_out, unicode):
+            _out = _out.encode('utf-8')
 
-    def write_all(self):
+        if atomic_write(config_file, _out):
+            metrics.increment('config_writes')
+            log('Wrote template %s.' % config_file, level=INFO)
+        else:
+            log('Template %s rendered unchanged.' % config_file, level=INFO)
+        rendered[config_file] = {
+            'digest': digest,
+            'content': hashlib.sha256(_out).hexdigest(),
+        }
+        save_state('rendered-configs', rendered)
+
+    def write_all(self, workers=None):
         """
         Write out all registered config files.
+
+        With more than one worker (default: the workers the renderer was
+        created with), the context generators of all templates are first
+        run concurrently, so generators waiting on hook tools and other
+        commands overlap.  Their log messages are replayed in registration
+        order, and the templates are then rendered and written one after
+        another as usual, so output and logging are deterministic.
         """
+        workers = workers or self.workers
+        if workers > 1:
+            self._resolve_contexts(workers)
         [self.write(k) for k in self.templates.iterkeys()]
 
+    def _resolve_contexts(self, workers):
+        generators = []
+        seen = set()
+        for tmpl in self.templates.itervalues():
+            for context in tmpl.contexts:
+                key = context_cache.key(context)
+                if key not in seen and context not in context_cache:
+                    seen.add(key)
+                    generators.append(context)
+        if not generators:
+            return
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(generators)))
+        try:
+            results = pool.map(_run_captured, generators)
+        finally:
+            pool.close()
+            pool.join()
+        for context, (result, messages) in zip(generators, results):
+            for message, level in messages:
+                log(message, level=level)
+            context_cache.put(context, result)
+
+    def dependencies(self):
+        '''
+        Returns the dependency graph of the registered config files: a
+        mapping of each interface provided by their context generators to
+        the config files rendered with it, in registration order.
+        '''
+        graph = OrderedDict()
+        for config_file, tmpl in self.templates.iteritems():
+            for context in tmpl.contexts:
+                for interface in context.interfaces:
+                    files = graph.setdefault(interface, [])
+                    if config_file not in files:
+                        files.append(config_file)
+        return graph
+
+    def files_for(self, interfaces):
+        '''
+        Returns the registered config files rendered with a context
+        generator providing any of interfaces, in registration order.
+        '''
+        graph = self.dependencies()
+        affected = set()
+        for interface in interfaces:
+            affected.update(graph.get(interface, []))
+        return [f for f in self.templates if f in affected]
+
+    def write_for(self, interfaces):
+        '''
+        Write out the config files that the relation data or config behind
+        interfaces can affect, and return them.  Files that do not depend
+        on any of interfaces are neither rendered nor written.
+        '''
+        config_files = self.files_for(interfaces)
+        [self.write(f) for f in config_files]
+        return config_files
+
     def set_release(self, openstack_release):
         """
         Resets the template environment and generates a new template loader
@@ -278,3 +534,22 @@ class OSConfigRenderer(object):
         [interfaces.extend(i.complete_contexts())
          for i in self.templates.itervalues()]
         return interfaces
+
+    def context_fingerprint(self, interfaces):
+        '''
+        Returns a digest of the relation data read by the registered context
+        generators that provide any of interfaces.  It only changes when
+        relation data that can affect the rendered configs changes.
+        '''
+        generators = {}
+        for tmpl in self.templates.itervalues():
+            for context in tmpl.contexts:
+                if set(context.interfaces) & set(interfaces):
+                    # generators are registered once per config file
+                    generators.setdefault(context.__class__, context)
+        with recording_relation_reads() as reads:
+            for context in generators.itervalues():
+                context_cache.put(context, context())
+        # values may be dicts, eg. a unit's complete settings
+        return hashlib.sha256(json.dumps(sorted(reads.iteritems()),
+                                         sort_keys=True)).hexdigest()
@@ -3,7 +3,6 @@
 # Common python helper functions used for OpenStack charms.
 from collections import OrderedDict
 
-import apt_pkg as apt
 import subprocess
 import os
 import socket
@@ -13,6 +12,8 @@ from charmhelpers.core.hookenv import (
     config,
     log as juju_log,
     charm_dir,
+    load_state,
+    save_state,
     ERROR,
     INFO
 )
@@ -24,7 +25,13 @@ from charmhelpers.contrib.storage.linux.lvm import (
 )
 
 from charmhelpers.core.host import lsb_release, mounts, umount
-from charmhelpers.fetch import apt_install
+from charmhelpers.fetch import (
+    apt_install,
+    filter_installed_packages,
+    sources_fingerprint,
+    installed_version,
+    upstream_version,
+)
 from charmhelpers.contrib.storage.linux.utils import is_block_device, zap_disk
 from charmhelpers.contrib.storage.linux.loopback import ensure_loopback_device
 
@@ -34,6 +41,19 @@ CLOUD_ARCHIVE_KEY_ID = '5EDB1B62EC4926EA'
 DISTRO_PROPOSED = ('deb http://archive.ubuntu.com/ubuntu/ %s-proposed '
                    'restricted main multiverse universe')
 
+# map charm config options to actual archive pockets.
+CLOUD_ARCHIVE_POCKETS = {
+    'folsom': 'precise-updates/folsom',
+    'folsom/updates': 'precise-updates/folsom',
+    'folsom/proposed': 'precise-proposed/folsom',
+    'grizzly': 'precise-updates/grizzly',
+    'grizzly/updates': 'precise-updates/grizzly',
+    'grizzly/proposed': 'precise-proposed/grizzly',
+    'havana': 'precise-updates/havana',
+    'havana/updates': 'precise-updates/havana',
+    'havana/proposed': 'precise-proposed/havana',
+}
+
 
 UBUNTU_OPENSTACK_RELEASE = OrderedDict([
     ('oneiric', 'diablo'),
@@ -125,30 +145,19 @@ def get_os_version_codename(codename):
 
 def get_os_codename_package(package, fatal=True):
     '''Derive OpenStack release codename from an installed package.'''
-    apt.init()
-    cache = apt.Cache()
-
-    try:
-        pkg = cache[package]
-    except:
-        if not fatal:
-            return None
-        # the package is unknown to the current apt cache.
-        e = 'Could not determine version of package with no installation '\
-            'candidate: %s' % package
-        error_out(e)
+    ver_str = installed_version(package)
 
-    if not pkg.current_ver:
+    if not ver_str:
         if not fatal:
             return None
-        # package is known, but no version is currently installed.
+        # no version of the package is currently installed.
         e = 'Could not determine version of uninstalled package: %s' % package
         error_out(e)
 
-    vers = apt.upstream_version(pkg.current_ver.ver_str)
+    vers = upstream_version(ver_str)
 
     try:
-        if 'swift' in pkg.name:
+        if 'swift' in package:
             swift_vers = vers[:5]
             if swift_vers not in SWIFT_CODENAMES:
                 # Deal with 1.10.0 upward
@@ -209,11 +218,42 @@ def import_key(keyid):
         error_out("Error importing repo key %s" % keyid)
 
 
-def configure_installation_source(rel):
-    '''Configure apt installation source.'''
+def cloud_archive_pocket(rel):
+    '''
+    Returns the Cloud Archive pocket for a cloud: installation source, eg.
+    precise-updates/havana for cloud:precise-havana, or None for other
+    sources.
+    '''
+    if rel[:6] != 'cloud:' or '-' not in rel:
+        return None
+    return CLOUD_ARCHIVE_POCKETS.get(rel.split(':')[1].split('-', 1)[1])
+
+
+def configure_installation_source(rel, mirror=None):
+    '''
+    Configure apt installation source.
+
+    Cloud Archive pockets are fetched from mirror instead of the Cloud
+    Archive when one is given.  Nothing is done if rel and mirror are the
+    source last configured and the apt sources and keys have not changed
+    since.
+    '''
     if rel == 'distro':
         return
-    elif rel == 'distro-proposed':
+    configured = load_state('installation-source', {})
+    if (configured.get('source') == rel and
+            configured.get('mirror') == mirror and
+            configured.get('fingerprint') == sources_fingerprint()):
+        juju_log('Installation source %s is already configured.' % rel)
+        return
+    _configure_installation_source(rel, mirror or CLOUD_ARCHIVE_URL)
+    save_state('installation-source', {'source': rel,
+                                       'mirror': mirror,
+                                       'fingerprint': sources_fingerprint()})
+
+
+def _configure_installation_source(rel, cloud_archive_url):
+    if rel == 'distro-proposed':
         ubuntu_rel = lsb_release()['DISTRIB_CODENAME']
         with open('/etc/apt/sources.list.d/juju_deb.list', 'w') as f:
             f.write(DISTRO_PROPOSED % ubuntu_rel)
@@ -249,27 +289,15 @@ def configure_installation_source(rel):
             subprocess.check_call(cmd.split(' '))
             return
 
-        # map charm config options to actual archive pockets.
-        pockets = {
-            'folsom': 'precise-updates/folsom',
-            'folsom/updates': 'precise-updates/folsom',
-            'folsom/proposed': 'precise-proposed/folsom',
-            'grizzly': 'precise-updates/grizzly',
-            'grizzly/updates': 'precise-updates/grizzly',
-            'grizzly/proposed': 'precise-proposed/grizzly',
-            'havana': 'precise-updates/havana',
-            'havana/updates': 'precise-updates/havana',
-            'havana/proposed': 'precise-proposed/havana',
-        }
-
         try:
-            pocket = pockets[ca_rel]
+            pocket = CLOUD_ARCHIVE_POCKETS[ca_rel]
         except KeyError:
             e = 'Invalid Cloud Archive release specified: %s' % rel
             error_out(e)
 
-        src = "deb %s %s main" % (CLOUD_ARCHIVE_URL, pocket)
-        apt_install('ubuntu-cloud-keyring', fatal=True)
+        src = "deb %s %s main" % (cloud_archive_url, pocket)
+        if filter_installed_packages(['ubuntu-cloud-keyring']):
+            apt_install('ubuntu-cloud-keyring', fatal=True)
 
         with open('/etc/apt/sources.list.d/cloud-archive.list', 'w') as f:
             f.write(src)
@@ -310,8 +338,9 @@ def openstack_upgrade_available(package):
     src = config('openstack-origin')
     cur_vers = get_os_version_package(package)
     available_vers = get_os_version_install_source(src)
-    apt.init()
-    return apt.version_compare(available_vers, cur_vers) == 1
+    # both are dotted numeric versions from the codename maps above
+    return ([int(v) for v in available_vers.split('.')] >
+            [int(v) for v in cur_vers.split('.')])
 
 
 def ensure_block_device(block_device):
@@ -5,20 +5,75 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 import os
+import atexit
 import json
-import yaml
+import hashlib
+import inspect
+import threading
 import subprocess
 import UserDict
+from contextlib import contextmanager
 from subprocess import CalledProcessError
 
+from charmhelpers.core import metrics, tracing
+
+tracing.install()
+
 CRITICAL = "CRITICAL"
 ERROR = "ERROR"
 WARNING = "WARNING"
 INFO = "INFO"
 DEBUG = "DEBUG"
+LOG_LEVELS = [DEBUG, INFO, WARNING, ERROR, CRITICAL]
 MARKER = object()
 
 cache = {}
+# secondary indexes into cache, mapping functions and relation ids to the
+# keys of their cached entries
+cache_by_func = {}
+cache_by_rid = {}
+cache_rid = {}
+# per key locks, so threads missing the same entry call func only once
+_cache_locks = {}
+_cache_locks_lock = threading.Lock()
+relation_cache = {}
+config_cache = None
+_config_lock = threading.Lock()
+# relation settings queued by relation_set, keyed by relation id
+pending_relation_settings = None
+# unit state queued by save_state_on_success, keyed by name
+pending_state = None
+# relation data returned by relation_get while recording
+relation_reads = None
+# bumped whenever cached relation data or config is flushed, so results
+# derived from them can be invalidated
+data_generation = 0
+log_buffer = []
+# messages logged by threads running inside captured_log
+_log_capture = threading.local()
+log_level = os.environ.get('CHARM_LOG_LEVEL', DEBUG)
+# hook tool invocations answered from a snapshot, keyed by tool name
+saved_calls = {}
+
+# argument names used for relation ids by cached functions
+RELATION_ID_ARGS = ('rid', 'relid', 'relation_id')
+
+
+def _cache_key(func, args, kwargs):
+    key = (func, args, tuple(sorted(kwargs.iteritems())))
+    try:
+        hash(key)
+    except TypeError:
+        # unhashable arguments, eg. a list of relation keys
+        key = (func, repr(args), repr(sorted(kwargs.iteritems())))
+    return key
+
+
+def _cache_drop(key):
+    cache.pop(key, None)
+    cache_by_func.get(key[0], set()).discard(key)
+    if key in cache_rid:
+        cache_by_rid.get(cache_rid.pop(key), set()).discard(key)
 
 
 def cached(func):
@@ -33,37 +88,164 @@ def cached(func):
         unit_get('test')
 
     will cache the result of unit_get + 'test' for future calls.
+
+    Entries are indexed by function and, for functions taking a relation
+    id argument, by relation id so they can be invalidated precisely.
     """
+    argnames = inspect.getargspec(func).args
+    rid_arg = None
+    for name in RELATION_ID_ARGS:
+        if name in argnames:
+            rid_arg = (name, argnames.index(name))
+
     def wrapper(*args, **kwargs):
-        global cache
-        key = str((func, args, kwargs))
+        key = _cache_key(func, args, kwargs)
         try:
             return cache[key]
         except KeyError:
+            pass
+        with _cache_locks_lock:
+            lock = _cache_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key in cache:
+                return cache[key]
             res = func(*args, **kwargs)
             cache[key] = res
-            return res
+        cache_by_func.setdefault(func, set()).add(key)
+        if rid_arg:
+            name, position = rid_arg
+            if name in kwargs:
+                rid = kwargs[name]
+            elif position < len(args):
+                rid = args[position]
+            else:
+                rid = None
+            # relation functions default to the current relation
+            rid = rid or os.environ.get('JUJU_RELATION_ID', None)
+            cache_by_rid.setdefault(rid, set()).add(key)
+            cache_rid[key] = rid
+        return res
+    wrapper.cached_func = func
     return wrapper
 
 
+def _data_changed():
+    global data_generation
+    data_generation += 1
+
+
 def flush(key):
     """Flushes any entries from function cache where the
     key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    for item in [item for item in cache if key in str(item)]:
+        _cache_drop(item)
+    _data_changed()
+
+
+def flush_func(func):
+    """Flushes all cached entries of a function decorated with cached"""
+    func = getattr(func, 'cached_func', func)
+    for key in list(cache_by_func.get(func, ())):
+        _cache_drop(key)
+    _data_changed()
+
+
+def flush_relation(rid, published=True):
+    """Flushes cached entries that may include the local unit's settings
+    on relation rid.  With published=False the snapshot of the settings
+    already published is kept, eg. when new settings are only queued."""
+    for key in list(cache_by_rid.get(rid, ())):
+        _cache_drop(key)
+    if published:
+        relation_cache.pop((rid, local_unit()), None)
+    flush_func(relations)
+
+
+def reset():
+    """Forget all per-hook state, for running another hook in the same
+    process"""
+    global config_cache, pending_relation_settings, pending_state, log_level
+    for state in (cache, cache_by_func, cache_by_rid, cache_rid,
+                  relation_cache, _cache_locks, saved_calls,
+                  metrics.counters):
+        state.clear()
+    config_cache = None
+    pending_relation_settings = None
+    pending_state = None
+    del log_buffer[:]
+    # the environment may be another hook's, eg. in the hook server
+    log_level = os.environ.get('CHARM_LOG_LEVEL', DEBUG)
+    tracing.enabled = bool(os.environ.get(tracing.TRACE_ENV))
+    metrics.textfile_dir = os.environ.get(metrics.METRICS_DIR_ENV)
+    tracing.reset()
+    _data_changed()
+
+
+def _log_rank(level):
+    try:
+        return LOG_LEVELS.index(level or INFO)
+    except ValueError:
+        return LOG_LEVELS.index(INFO)
+
+
+def set_log_level(level):
+    """Set the minimum level of messages written to the juju log"""
+    global log_level
+    log_level = level
 
 
 def log(message, level=None):
-    """Write a message to the juju log"""
-    command = ['juju-log']
-    if level:
-        command += ['-l', level]
-    command += [message]
-    subprocess.call(command)
+    """Write a message to the juju log
+
+    Messages are buffered and written by log_flush at hook exit.  WARNING
+    and above flush the buffer immediately, so real problems are logged in
+    order with everything before them.  Messages below the minimum level,
+    set with set_log_level or $CHARM_LOG_LEVEL, are dropped.
+    """
+    if _log_rank(level) < _log_rank(log_level):
+        return
+    captured = getattr(_log_capture, 'messages', None)
+    if captured is not None:
+        captured.append((message, level))
+        return
+    log_buffer.append((level or INFO, message))
+    if _log_rank(level) >= _log_rank(WARNING):
+        log_flush()
+
+
+@contextmanager
+def captured_log():
+    """Collect the messages logged by this thread within the block.
+
+    Yields the list of (message, level) logged, for the caller to replay
+    with log() in a deterministic order.
+    """
+    _log_capture.messages = []
+    try:
+        yield _log_capture.messages
+    finally:
+        _log_capture.messages = None
+
+
+def log_flush():
+    """Write out buffered log messages, with one juju-log invocation for
+    each run of consecutive messages at the same level"""
+    while log_buffer:
+        level = log_buffer[0][0]
+        messages = []
+        while log_buffer and log_buffer[0][0] == level:
+            messages.append(log_buffer.pop(0)[1])
+        subprocess.call(['juju-log', '-l', level, '\n'.join(messages)])
+
+
+def _log_flush_at_exit():
+    try:
+        log_flush()
+    except OSError:
+        # juju-log is not available outside of a hook context
+        pass
+
+atexit.register(_log_flush_at_exit)
 
 
 class Serializable(UserDict.IterableUserDict):
@@ -102,6 +284,7 @@ class Serializable(UserDict.IterableUserDict):
 
     def yaml(self):
         """Serialize the object to yaml"""
+        import yaml
         return yaml.dump(self.data)
 
 
@@ -149,52 +332,259 @@ def service_name():
     return local_unit().split('/')[0]
 
 
-@cached
+def _saved_call(tool):
+    """Count a hook tool invocation that was answered from a snapshot"""
+    saved_calls[tool] = saved_calls.get(tool, 0) + 1
+
+
 def config(scope=None):
-    """Juju charm configuration"""
-    config_cmd_line = ['config-get']
+    """Juju charm configuration
+
+    The whole configuration is loaded with a single config-get the first
+    time it is needed; every later lookup, scoped or not, is answered from
+    that snapshot for the rest of the hook.
+    """
+    global config_cache
+    with _config_lock:
+        if config_cache is None:
+            try:
+                config_cache = json.loads(
+                    subprocess.check_output(['config-get', '--format=json']))
+            except ValueError:
+                config_cache = {}
+        else:
+            _saved_call('config-get')
     if scope is not None:
-        config_cmd_line.append(scope)
-    config_cmd_line.append('--format=json')
+        return config_cache.get(scope)
+    return dict(config_cache)
+
+
+def unit_state_dir():
+    """Return the directory holding state this unit keeps between hooks"""
+    return os.environ.get('CHARM_STATE_DIR',
+                          os.path.join(charm_dir() or '', '.unit-state'))
+
+
+def load_state(name, default=None):
+    """Load a json document previously stored with save_state, or queued
+    by save_state_on_success in this hook"""
+    if pending_state and name in pending_state:
+        return json.loads(pending_state[name])
+    path = os.path.join(unit_state_dir(), '{}.json'.format(name))
     try:
-        return json.loads(subprocess.check_output(config_cmd_line))
-    except ValueError:
-        return None
+        with open(path) as state:
+            return json.load(state)
+    except (IOError, ValueError):
+        return default
+
+
+def save_state(name, data):
+    """Atomically store a json serializable document in unit state,
+    replacing any queued by save_state_on_success in this hook"""
+    if pending_state:
+        pending_state.pop(name, None)
+    state_dir = unit_state_dir()
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir, 0700)
+    path = os.path.join(state_dir, '{}.json'.format(name))
+    try:
+        with open(path + '.tmp', 'w') as state:
+            json.dump(data, state)
+    except Exception:
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        raise
+    os.rename(path + '.tmp', path)
 
 
-@cached
-def relation_get(attribute=None, unit=None, rid=None):
-    """Get relation information"""
+def save_state_on_success(name, data):
+    """Store data with save_state once the hook has completed and its
+    relation settings are written by flush_relation_set, so state recording
+    what a hook did is not kept when juju discards the hook's work.  Stored
+    straight away outside of Hooks.execute."""
+    if pending_state is None:
+        save_state(name, data)
+    else:
+        pending_state[name] = json.dumps(data)
+
+
+def _config_digests():
+    return dict((k, hashlib.sha256(json.dumps(v, sort_keys=True)).hexdigest())
+                for k, v in config().iteritems())
+
+
+def config_changed_keys():
+    """Return the set of config keys changed since the config fingerprint
+    was last saved.  Every key is considered changed if there is none."""
+    previous = load_state('config-fingerprint')
+    current = _config_digests()
+    if previous is None:
+        return set(current)
+    return set(k for k in set(current) | set(previous)
+               if current.get(k) != previous.get(k))
+
+
+def save_config_fingerprint():
+    """Record digests of the current config values, so that the next
+    config_changed_keys only reports keys changed after this point.  Saved
+    when the hook succeeds, see save_state_on_success."""
+    save_state_on_success('config-fingerprint', _config_digests())
+
+
+def relation_snapshot(rid=None, unit=None):
+    """Get the complete settings of unit on relation rid.
+
+    The settings are fetched with a single relation-get and kept for the
+    rest of the hook, so later lookups of individual keys for the same
+    (rid, unit) do not start another hook tool process.
+    """
+    key = (rid, unit)
+    if key in relation_cache:
+        _saved_call('relation-get')
+        return relation_cache[key]
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
         _args.append(rid)
-    _args.append(attribute or '-')
+    _args.append('-')
     if unit:
         _args.append(unit)
     try:
-        return json.loads(subprocess.check_output(_args))
+        settings = json.loads(subprocess.check_output(_args))
     except ValueError:
-        return None
+        settings = None
     except CalledProcessError, e:
-        if e.returncode == 2:
-            return None
-        raise
+        if e.returncode != 2:
+            raise
+        settings = None
+    relation_cache[key] = settings
+    return settings
 
 
-def relation_set(relation_id=None, relation_settings={}, **kwargs):
-    """Set relation information for the current unit"""
+def relation_get(attribute=None, unit=None, rid=None):
+    """Get relation information"""
+    rid = rid or relation_id()
+    if unit is None and rid == relation_id():
+        # relation-get defaults to the remote unit of the current hook
+        unit = os.environ.get('JUJU_REMOTE_UNIT', None)
+    settings = relation_snapshot(rid, unit)
+    if (pending_relation_settings and rid in pending_relation_settings and
+            unit == os.environ.get('JUJU_UNIT_NAME', None)):
+        # read back settings queued by relation_set
+        settings = dict(settings or {})
+        for k, v in pending_relation_settings[rid].iteritems():
+            settings[k] = _published(v)
+    if settings is None:
+        value = None
+    elif attribute is None:
+        # callers are free to modify the returned dict
+        value = dict(settings)
+    else:
+        value = settings.get(attribute)
+    if relation_reads is not None:
+        relation_reads[(rid, unit, attribute)] = value
+    return value
+
+
+def _relation_set(relation_id, settings):
     relation_cmd_line = ['relation-set']
     if relation_id is not None:
         relation_cmd_line.extend(('-r', relation_id))
-    for k, v in (relation_settings.items() + kwargs.items()):
+    for k, v in settings.items():
         if v is None:
             relation_cmd_line.append('{}='.format(k))
         else:
             relation_cmd_line.append('{}={}'.format(k, v))
     subprocess.check_call(relation_cmd_line)
-    # Flush cache of any relation-gets for local unit
-    flush(local_unit())
+
+
+@contextmanager
+def recording_relation_reads():
+    """Record the relation data returned by relation_get within the block
+
+    Yields a dict mapping (rid, unit, attribute) to the value returned.
+    """
+    global relation_reads
+    previous, relation_reads = relation_reads, {}
+    try:
+        yield relation_reads
+    finally:
+        if previous is not None:
+            previous.update(relation_reads)
+        relation_reads = previous
+
+
+def relation_set(relation_id=None, relation_settings={}, **kwargs):
+    """Set relation information for the current unit
+
+    While Hooks.execute runs a hook, settings are queued and merged per
+    relation id, and written once by flush_relation_set when the hook
+    completes.
+    """
+    rid = relation_id or os.environ.get('JUJU_RELATION_ID', None)
+    settings = dict(relation_settings.items() + kwargs.items())
+    if pending_relation_settings is not None and rid is not None:
+        pending_relation_settings.setdefault(rid, {}).update(settings)
+        # relation_get reads the queued settings back over the snapshot
+        flush_relation(rid, published=False)
+    else:
+        _relation_set(relation_id, settings)
+        # Flush cache of any relation-gets for local unit
+        flush_relation(rid)
+
+
+def _published(value):
+    """The value relation-get returns after relation-set of value"""
+    if value is None or value == '':
+        return None
+    return '{}'.format(value)
+
+
+def defer_relation_set():
+    """Queue relation_set and save_state_on_success calls until
+    flush_relation_set"""
+    global pending_relation_settings, pending_state
+    if pending_relation_settings is None:
+        pending_relation_settings = {}
+    if pending_state is None:
+        pending_state = {}
+
+
+def discard_relation_set():
+    """Drop queued relation settings and state and stop queueing"""
+    global pending_relation_settings, pending_state
+    pending_relation_settings = None
+    pending_state = None
+
+
+def flush_relation_set():
+    """Write the queued relation settings with one relation-set per relation
+    id, then the state queued by save_state_on_success.
+
+    Values matching what is already published are left out when the
+    hook has read the local unit's settings on the relation; they are not
+    fetched just for the comparison, which would cost as much as the
+    relation-set it might save.
+    """
+    global pending_relation_settings, pending_state
+    queued, pending_relation_settings = pending_relation_settings, None
+    states, pending_state = pending_state, None
+    for rid, settings in sorted((queued or {}).iteritems()):
+        published = relation_cache.get((rid, local_unit()), MARKER)
+        if published is MARKER:
+            changed = settings
+        else:
+            published = published or {}
+            changed = dict((k, v) for k, v in settings.iteritems()
+                           if _published(v) != published.get(k))
+        if changed:
+            _relation_set(rid, changed)
+            flush_relation(rid)
+        else:
+            log('Relation settings for {} are already published'.format(rid),
+                level=DEBUG)
+    for name, data in sorted((states or {}).iteritems()):
+        save_state(name, json.loads(data))
 
 
 @cached
@@ -257,6 +647,7 @@ def relations_of_type(reltype=None):
 @cached
 def relation_types():
     """Get a list of relation types supported by this charm"""
+    import yaml
     charmdir = os.environ.get('CHARM_DIR', '')
     mdf = open(os.path.join(charmdir, 'metadata.yaml'))
     md = yaml.safe_load(mdf)
@@ -363,18 +754,57 @@ class Hooks(object):
     def __init__(self):
         super(Hooks, self).__init__()
         self._hooks = {}
+        self._after = []
 
     def register(self, name, function):
         """Register a hook"""
         self._hooks[name] = function
 
+    def after(self, function):
+        """Decorator, registering function to run after every hook, eg. to
+        resume work deferred by an earlier hook"""
+        self._after.append(function)
+        return function
+
     def execute(self, args):
         """Execute a registered hook based on args[0]"""
         hook_name = os.path.basename(args[0])
-        if hook_name in self._hooks:
-            self._hooks[hook_name]()
-        else:
-            raise UnregisteredHookError(hook_name)
+        timer = metrics.HookTimer(lambda: sum(tracing.call_counts.values()))
+        failed = True
+        defer_relation_set()
+        try:
+            if hook_name in self._hooks:
+                self._hooks[hook_name]()
+            else:
+                raise UnregisteredHookError(hook_name)
+            for function in self._after:
+                function()
+            flush_relation_set()
+            failed = False
+            if saved_calls:
+                log('Hook tool calls answered from snapshots: {}'.format(
+                    ', '.join('{}={}'.format(tool, count) for tool, count
+                              in sorted(saved_calls.iteritems()))),
+                    level=DEBUG)
+        finally:
+            if tracing.enabled:
+                log(tracing.report(hook_name, os.path.join(unit_state_dir(),
+                                                           'traces')))
+            if metrics.textfile_dir:
+                self._write_metrics(hook_name, timer.sample(), failed)
+            # juju discards the relation settings of a failed hook anyway
+            discard_relation_set()
+            log_flush()
+
+    def _write_metrics(self, hook_name, sample, failed):
+        try:
+            state = metrics.update(load_state('hook-metrics', {}),
+                                   hook_name, sample, failed)
+            save_state('hook-metrics', state)
+            metrics.write_textfile(metrics.textfile_dir, local_unit(),
+                                   metrics.render(state, local_unit()))
+        except (IOError, OSError) as e:
+            log('Could not write hook metrics: {}'.format(e), level=WARNING)
 
     def hook(self, *hook_names):
         """Decorator, registering them as hooks"""
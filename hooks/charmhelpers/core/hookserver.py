@@ -0,0 +1,234 @@
+"A long-lived per-unit process that executes hooks without re-importing"
+# Copyright 2013 Canonical Ltd.
+#
+# Authors:
+#  Charm Helpers Developers <juju@lists.ubuntu.com>
+#
+# Hook entry points call run_client() before importing anything else, so
+# this module must only import from the standard library at module level.
+
+import os
+import sys
+import json
+import errno
+import socket
+import traceback
+
+SOCKET_NAME = 'hookserver.sock'
+SERVE_ARG = '--serve'
+# hooks that start, stop or replace the server always run in-process
+IN_PROCESS_HOOKS = ['install', 'start', 'stop', 'upgrade-charm']
+
+# set in the server process and inherited by the hooks it runs
+serving = False
+
+
+def socket_path():
+    """Path of the server socket in the unit state directory"""
+    # keep in sync with hookenv.unit_state_dir, which is not imported here
+    state_dir = os.environ.get(
+        'CHARM_STATE_DIR',
+        os.path.join(os.environ.get('CHARM_DIR', ''), '.unit-state'))
+    return os.path.join(state_dir, SOCKET_NAME)
+
+
+def _send(conn, message):
+    conn.sendall(json.dumps(message) + '\n')
+
+
+def _receive(conn):
+    data = ''
+    while not data.endswith('\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data) if data else None
+
+
+def _request(message, path=None):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path or socket_path())
+        _send(conn, message)
+        return _receive(conn)
+    finally:
+        conn.close()
+
+
+def run_client(argv, path=None):
+    """Ask a running hook server to execute the hook named by argv[0].
+
+    Returns the hook's exit status, or None when the hook has to be run
+    in-process because no server is listening.
+    """
+    if (os.path.basename(argv[0]) in IN_PROCESS_HOOKS or
+            SERVE_ARG in argv[1:]):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            conn.connect(path or socket_path())
+        except socket.error:
+            return None
+        # once the request is sent the hook may have run, so it must not
+        # be retried in-process
+        try:
+            _send(conn, {
+                'argv': argv,
+                'env': dict(os.environ),
+                'cwd': os.getcwd(),
+                'pid': os.getpid(),
+            })
+            reply = _receive(conn)
+        except (socket.error, ValueError):
+            reply = None
+    finally:
+        conn.close()
+    if not reply or 'status' not in reply:
+        sys.stderr.write('Hook server did not report the hook status\n')
+        return 1
+    return reply['status']
+
+
+def running(path=None):
+    """Whether a hook server answers on the socket"""
+    if serving:
+        return True
+    try:
+        return (_request({'command': 'ping'}, path) or {}).get('pong', False)
+    except (socket.error, ValueError):
+        return False
+
+
+def start(script, path=None):
+    """Start a detached hook server running script, unless one is running"""
+    import subprocess
+    if running(path):
+        return
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen([sys.executable, script, SERVE_ARG],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid,
+                         cwd=os.environ.get('CHARM_DIR', None))
+
+
+def stop(path=None):
+    """Ask a running hook server to exit once it has finished the current
+    hook, which may be the one calling stop"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path or socket_path())
+        _send(conn, {'command': 'stop'})
+    except socket.error:
+        pass
+    finally:
+        conn.close()
+
+
+def _attach_output(pid):
+    """Send this process' output to the client's stdout and stderr"""
+    for fd in (1, 2):
+        try:
+            target = os.open('/proc/{}/fd/{}'.format(pid, fd), os.O_WRONLY)
+        except OSError:
+            continue
+        os.dup2(target, fd)
+        os.close(target)
+
+
+def _run_hook(hooks, request, setup):
+    """Run a single hook in a forked child and return its exit status"""
+    pid = os.fork()
+    if pid:
+        while True:
+            try:
+                _, status = os.waitpid(pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        if os.WIFEXITED(status):
+            return os.WEXITSTATUS(status)
+        return 1
+    from charmhelpers.core import hookenv
+    status = 1
+    try:
+        os.environ.clear()
+        for k, v in request['env'].iteritems():
+            os.environ[k.encode('utf-8')] = v.encode('utf-8')
+        os.chdir(request['cwd'])
+        _attach_output(request['pid'])
+        sys.argv = [arg.encode('utf-8') for arg in request['argv']]
+        # also picks up $CHARM_LOG_LEVEL, $CHARM_HOOK_TRACE and
+        # $CHARM_METRICS_DIR from the client's environment
+        hookenv.reset()
+        if setup:
+            setup()
+        hooks.execute(sys.argv)
+        status = 0
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except hookenv.UnregisteredHookError as e:
+        hookenv.log('Unknown hook {} - skipping.'.format(e))
+        status = 0
+    except Exception:
+        traceback.print_exc()
+    finally:
+        # the child must never return into the server's loop
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            hookenv.log_flush()
+        finally:
+            os._exit(status)
+
+
+def serve(hooks, setup=None, path=None):
+    """Execute hooks for clients connecting to the unit's socket.
+
+    The charm's modules are imported once by the server; each hook runs
+    in a forked child with the client's argv, environment (including the
+    hook tool socket) and working directory, with per-hook caches reset
+    and setup() called before the hook is executed.
+    """
+    from charmhelpers.core import hookenv
+    global serving
+    serving = True
+    # anything cached or logged while importing the charm belongs to the
+    # hook that started the server
+    hookenv.reset()
+    path = path or socket_path()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), 0700)
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(5)
+    try:
+        while True:
+            conn, _ = server.accept()
+            try:
+                request = _receive(conn)
+                if not request:
+                    continue
+                command = request.get('command')
+                if command == 'ping':
+                    _send(conn, {'pong': True})
+                elif command == 'stop':
+                    break
+                else:
+                    _send(conn, {'status': _run_hook(hooks, request, setup)})
+            except (socket.error, ValueError):
+                pass
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
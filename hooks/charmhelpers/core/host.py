@@ -16,6 +16,7 @@ import hashlib
 from collections import OrderedDict
 
 from hookenv import log
+from charmhelpers.core import metrics
 
 
 def service_start(service_name):
@@ -44,9 +45,68 @@ def service_reload(service_name, restart_on_failure=False):
 def service(action, service_name):
     """Control a system service"""
     cmd = ['service', service_name, action]
+    if action == 'restart':
+        metrics.increment('service_restarts')
     return subprocess.call(cmd) == 0
 
 
+# Ways of making a service pick up changed config, for restart_on_change.
+# All but RESTART keep serving established connections.
+RESTART = 'restart'
+# the init script's reload action
+RELOAD = 'reload'
+# apache2ctl graceful: children finish their requests before re-reading
+GRACEFUL = 'graceful'
+# a new haproxy takes over the listening sockets from the running ones,
+# which finish their connections and exit (-sf)
+HANDOFF = 'handoff'
+
+HAPROXY_CONF = '/etc/haproxy/haproxy.cfg'
+HAPROXY_PID = '/var/run/haproxy.pid'
+
+
+def apache_graceful(service_name='apache2'):
+    """Gracefully restart apache, after checking its config"""
+    return subprocess.call(['apache2ctl', 'graceful']) == 0
+
+
+def haproxy_handoff(service_name='haproxy', config=HAPROXY_CONF,
+                    pidfile=HAPROXY_PID):
+    """Hand haproxy's listening sockets over to a new process running the
+    current config.  Returns False, changing nothing, if haproxy is not
+    running or the config is invalid."""
+    try:
+        with open(pidfile) as f:
+            pids = f.read().split()
+    except IOError:
+        pids = []
+    if not pids:
+        return False
+    if subprocess.call(['haproxy', '-c', '-q', '-f', config]) != 0:
+        return False
+    return subprocess.call(['haproxy', '-f', config, '-p', pidfile, '-D',
+                            '-sf'] + pids) == 0
+
+
+RELOADS = {
+    RELOAD: lambda service_name: service('reload', service_name),
+    GRACEFUL: apache_graceful,
+    HANDOFF: haproxy_handoff,
+}
+
+
+def service_update(service_name, strategy=RESTART):
+    """Make service_name pick up changed config using strategy, one of
+    RESTART, RELOAD, GRACEFUL or HANDOFF, falling back to a restart if it
+    fails"""
+    if strategy != RESTART:
+        if RELOADS[strategy](service_name):
+            metrics.increment('service_reloads')
+            return True
+        log('{} of {} failed, restarting it'.format(strategy, service_name))
+    return service('restart', service_name)
+
+
 def service_running(service):
     """Determine whether a system service is running"""
     try:
@@ -132,6 +192,45 @@ def mkdir(path, owner='root', group='root', perms=0555, force=False):
     os.chown(realpath, uid, gid)
 
 
+# files changed by atomic_write, in order, consumed by restart_on_change
+changed_files = []
+# files only ever written with atomic_write, eg. registered with the
+# OpenStack config renderer, which restart_on_change does not checksum
+atomic_files = set()
+
+
+def atomic_write(path, content):
+    """Replace the contents of path, unless they are already content.
+
+    The new contents are written to a temporary file with the owner and
+    mode of the file being replaced, which is then renamed over it, so
+    path is never left partially written.  Returns True if path changed.
+    """
+    try:
+        with open(path, 'rb') as current:
+            if current.read() == content:
+                return False
+        st = os.stat(path)
+    except (IOError, OSError):
+        st = None
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as target:
+            if st is not None:
+                os.fchown(target.fileno(), st.st_uid, st.st_gid)
+                os.fchmod(target.fileno(), st.st_mode & 07777)
+            target.write(content)
+            target.flush()
+            os.fsync(target.fileno())
+        os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    changed_files.append(path)
+    return True
+
+
 def write_file(path, content, owner='root', group='root', perms=0444):
     """Create or overwrite a file with the contents of a string"""
     log("Writing file {} {}:{} {:o}".format(path, owner, group, perms))
@@ -194,7 +293,7 @@ def file_hash(path):
         return None
 
 
-def restart_on_change(restart_map):
+def restart_on_change(restart_map, schedule=None):
     """Restart services based on configuration files changing
 
     This function is used a decorator, for example
@@ -208,23 +307,59 @@ def restart_on_change(restart_map):
     In this example, the cinder-api and cinder-volume services
     would be restarted if /etc/ceph/ceph.conf is changed by the
     ceph_client_changed function.
+
+    A service may also be given as a (service, strategy) tuple, eg.
+    ('haproxy', HANDOFF), to have it reload its config rather than
+    restart; see service_update.  A service listed with different
+    strategies for several changed files is restarted if any of them
+    says so.
+
+    schedule, if given, is called with the services to update, as
+    returned by service_updates, and returns those to update now; it may
+    take over updating the others, eg. to stagger restarts across units.
+
+    Files written with atomic_write, which the OpenStack config renderer
+    uses, are known to have changed.  Any file in restart_map not listed
+    in atomic_files is also checked by comparing its checksum from before
+    and after f, so changes made any other way, eg. with write_file, still
+    update its services.
     """
     def wrap(f):
         def wrapped_f(*args):
-            checksums = {}
-            for path in restart_map:
-                checksums[path] = file_hash(path)
+            checksums = dict((path, file_hash(path)) for path in restart_map
+                             if path not in atomic_files)
+            start = len(changed_files)
             f(*args)
-            restarts = []
-            for path in restart_map:
-                if checksums[path] != file_hash(path):
-                    restarts += restart_map[path]
-            for service_name in list(OrderedDict.fromkeys(restarts)):
-                service('restart', service_name)
+            changed = changed_files[start:]
+            changed.extend(path for path in restart_map
+                           if path in checksums and path not in changed and
+                           file_hash(path) != checksums[path])
+            updates = service_updates(restart_map, changed)
+            if schedule is not None and updates:
+                updates = schedule(updates)
+            for service_name, strategy in updates.iteritems():
+                service_update(service_name, strategy)
         return wrapped_f
     return wrap
 
 
+def service_updates(restart_map, changed):
+    """Return an ordered mapping of the services in restart_map for the
+    changed files to the strategy used to update them"""
+    changed = set(changed)
+    updates = OrderedDict()
+    for path in restart_map:
+        if path not in changed:
+            continue
+        for entry in restart_map[path]:
+            if isinstance(entry, basestring):
+                entry = (entry, RESTART)
+            service_name, strategy = entry
+            if updates.get(service_name) != RESTART:
+                updates[service_name] = strategy
+    return updates
+
+
 def lsb_release():
     """Return /etc/lsb-release in a dict"""
     d = {}
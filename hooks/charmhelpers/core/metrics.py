@@ -0,0 +1,156 @@
+"Hook execution metrics in the Prometheus textfile format"
+# Copyright 2013 Canonical Ltd.
+#
+# Authors:
+#  Charm Helpers Developers <juju@lists.ubuntu.com>
+
+import os
+import time
+import resource
+
+METRICS_DIR_ENV = 'CHARM_METRICS_DIR'
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+HISTOGRAMS = (
+    ('duration_seconds', 'Wall time of hook executions.'),
+    ('cpu_seconds', 'CPU time of hook executions, including children.'),
+)
+GAUGES = (
+    ('duration_seconds', 'Wall time of the last execution.'),
+    ('cpu_seconds', 'CPU time of the last execution.'),
+    ('max_rss_bytes', 'Peak resident set size of the last execution.'),
+    ('subprocesses', 'Processes started by the last execution.'),
+    ('config_writes', 'Config files rewritten by the last execution.'),
+    ('service_restarts', 'Service restarts by the last execution.'),
+    ('service_reloads', 'Service reloads by the last execution.'),
+    ('timestamp_seconds', 'Time the last execution finished.'),
+)
+
+textfile_dir = os.environ.get(METRICS_DIR_ENV)
+# events counted during this hook execution, eg. config_writes
+counters = {}
+
+
+def configure(directory):
+    """Write metrics to directory, eg. the node-exporter textfile dir"""
+    global textfile_dir
+    textfile_dir = directory
+
+
+def increment(name, value=1):
+    """Count an event for the hook being executed"""
+    counters[name] = counters.get(name, 0) + value
+
+
+def _cpu_time():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+                                                 resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def _max_rss():
+    # ru_maxrss is reported in kilobytes on linux
+    return 1024 * max(resource.getrusage(who).ru_maxrss
+                      for who in (resource.RUSAGE_SELF,
+                                  resource.RUSAGE_CHILDREN))
+
+
+class HookTimer(object):
+    """Measures a single hook execution"""
+
+    def __init__(self, subprocess_count):
+        self.subprocess_count = subprocess_count
+        self.start = time.time()
+        self.start_cpu = _cpu_time()
+        self.start_subprocesses = subprocess_count()
+        counters.clear()
+
+    def sample(self):
+        return {
+            'duration_seconds': time.time() - self.start,
+            'cpu_seconds': _cpu_time() - self.start_cpu,
+            'max_rss_bytes': _max_rss(),
+            'subprocesses': self.subprocess_count() - self.start_subprocesses,
+            'config_writes': counters.get('config_writes', 0),
+            'service_restarts': counters.get('service_restarts', 0),
+            'service_reloads': counters.get('service_reloads', 0),
+            'timestamp_seconds': time.time(),
+        }
+
+
+def _observe(histogram, value):
+    buckets = histogram.setdefault('buckets', [0] * len(BUCKETS))
+    for i, bound in enumerate(BUCKETS):
+        if value <= bound:
+            buckets[i] += 1
+    histogram['sum'] = histogram.get('sum', 0.0) + value
+    histogram['count'] = histogram.get('count', 0) + 1
+
+
+def update(state, hook_name, sample, failed=False):
+    """Add a hook execution sample to the accumulated metrics state"""
+    hook = state.setdefault(hook_name, {})
+    for name, _ in HISTOGRAMS:
+        _observe(hook.setdefault(name, {}), sample[name])
+    hook['last'] = sample
+    hook['runs'] = hook.get('runs', 0) + 1
+    hook['failures'] = hook.get('failures', 0) + (1 if failed else 0)
+    return state
+
+
+def _labels(unit, hook_name, **extra):
+    labels = [('unit', unit), ('hook', hook_name)] + sorted(extra.items())
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+def render(state, unit):
+    """Render the accumulated metrics state in the textfile format"""
+    lines = []
+    hooks = sorted(state.iteritems())
+    for name, doc in HISTOGRAMS:
+        metric = 'juju_hook_' + name
+        lines.append('# HELP {} {}'.format(metric, doc))
+        lines.append('# TYPE {} histogram'.format(metric))
+        for hook_name, hook in hooks:
+            histogram = hook[name]
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                lines.append('{}_bucket{} {}'.format(
+                    metric, _labels(unit, hook_name, le=bound), count))
+            lines.append('{}_bucket{} {}'.format(
+                metric, _labels(unit, hook_name, le='+Inf'),
+                histogram['count']))
+            lines.append('{}_sum{} {}'.format(
+                metric, _labels(unit, hook_name), histogram['sum']))
+            lines.append('{}_count{} {}'.format(
+                metric, _labels(unit, hook_name), histogram['count']))
+    for name, doc in GAUGES:
+        metric = 'juju_hook_last_' + name
+        lines.append('# HELP {} {}'.format(metric, doc))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for hook_name, hook in hooks:
+            # state saved by older versions may lack newer gauges
+            lines.append('{}{} {}'.format(metric, _labels(unit, hook_name),
+                                          hook['last'].get(name, 0)))
+    for name, doc in (('runs', 'Hook executions.'),
+                      ('failures', 'Hook executions that raised.')):
+        metric = 'juju_hook_{}_total'.format(name)
+        lines.append('# HELP {} {}'.format(metric, doc))
+        lines.append('# TYPE {} counter'.format(metric))
+        for hook_name, hook in hooks:
+            lines.append('{}{} {}'.format(metric, _labels(unit, hook_name),
+                                          hook[name]))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(directory, unit, text):
+    """Atomically replace the unit's metrics file in directory"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory,
+                        'juju-hooks-{}.prom'.format(unit.replace('/', '-')))
+    # the textfile collector only reads *.prom, so it never sees the
+    # partially written file
+    tmp = '{}.{}'.format(path, os.getpid())
+    with open(tmp, 'w') as out:
+        out.write(text)
+    os.rename(tmp, path)
+    return path
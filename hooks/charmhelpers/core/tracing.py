@@ -0,0 +1,136 @@
+"Tracing of the processes started during hook execution"
+# Copyright 2013 Canonical Ltd.
+#
+# Authors:
+#  Charm Helpers Developers <juju@lists.ubuntu.com>
+
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+
+TRACE_ENV = 'CHARM_HOOK_TRACE'
+TRACED_FUNCS = ('call', 'check_call', 'check_output')
+
+enabled = bool(os.environ.get(TRACE_ENV))
+# number of processes started per tool, counted whether or not tracing
+# is enabled
+call_counts = {}
+# one record per process started while tracing is enabled
+calls = []
+
+# nesting of traced calls in each thread
+_local = threading.local()
+
+
+def enable():
+    """Start recording the processes started by this hook"""
+    global enabled
+    enabled = True
+
+
+def reset():
+    """Forget everything recorded so far"""
+    call_counts.clear()
+    del calls[:]
+
+
+def _tool(cmd):
+    if isinstance(cmd, basestring):
+        cmd = cmd.split()
+    if not cmd:
+        return None
+    return os.path.basename(cmd[0])
+
+
+def _caller():
+    """Describe the first frame outside of subprocess and the hook tool
+    wrappers in hookenv"""
+    skip = [os.path.splitext(f)[0] for f in (
+        __file__, subprocess.__file__,
+        os.path.join(os.path.dirname(__file__), 'hookenv.py'))]
+    frame = sys._getframe(1)
+    while frame and os.path.splitext(frame.f_code.co_filename)[0] in skip:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return '{}:{}:{}'.format(os.path.basename(frame.f_code.co_filename),
+                             frame.f_lineno, frame.f_code.co_name)
+
+
+def _wrap(name, func):
+    def traced(*args, **kwargs):
+        if getattr(_local, 'depth', 0):
+            # check_call is implemented with call; only trace the outer one
+            return func(*args, **kwargs)
+        cmd = args[0] if args else kwargs.get('args')
+        tool = _tool(cmd)
+        call_counts[tool] = call_counts.get(tool, 0) + 1
+        start = time.time()
+        _local.depth = 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.depth = 0
+            if enabled:
+                calls.append({
+                    'tool': tool,
+                    'command': cmd if isinstance(cmd, basestring)
+                    else ' '.join(cmd),
+                    'function': name,
+                    'caller': _caller(),
+                    'start': start,
+                    'time': time.time() - start,
+                })
+    traced.traced_func = func
+    traced.__name__ = func.__name__
+    traced.__doc__ = func.__doc__
+    return traced
+
+
+def install():
+    """Wrap the subprocess functions used to run hook tools and commands.
+
+    This must run before modules bind them with 'from subprocess import',
+    which is why hookenv installs the wrappers when it is imported.
+    """
+    for name in TRACED_FUNCS:
+        func = getattr(subprocess, name)
+        if not hasattr(func, 'traced_func'):
+            setattr(subprocess, name, _wrap(name, func))
+
+
+def summary(top=10):
+    """Return a text table of calls and time per tool plus the slowest
+    calls recorded"""
+    tools = {}
+    for c in calls:
+        count, total = tools.get(c['tool'], (0, 0.0))
+        tools[c['tool']] = (count + 1, total + c['time'])
+    lines = ['{:<24} {:>6} {:>10}'.format('tool', 'calls', 'total (s)')]
+    for tool, (count, total) in sorted(tools.iteritems(),
+                                       key=lambda t: t[1][1], reverse=True):
+        lines.append('{:<24} {:>6} {:>10.3f}'.format(tool, count, total))
+    lines.append('')
+    lines.append('slowest calls:')
+    for c in sorted(calls, key=lambda c: c['time'], reverse=True)[:top]:
+        lines.append('{:>8.3f}s  {}  ({})'.format(c['time'], c['command'],
+                                                   c['caller']))
+    return '\n'.join(lines)
+
+
+def report(hook_name, trace_dir):
+    """Write the json trace and summary table for this hook to trace_dir
+    and return the summary"""
+    if not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+    base = os.path.join(trace_dir, '{}-{}'.format(
+        hook_name, time.strftime('%Y%m%d%H%M%S')))
+    text = summary()
+    with open(base + '.json', 'w') as out:
+        json.dump({'hook': hook_name, 'calls': calls}, out, indent=2)
+    with open(base + '.txt', 'w') as out:
+        out.write(text + '\n')
+    return text
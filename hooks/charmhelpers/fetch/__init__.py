@@ -1,5 +1,8 @@
 import importlib
-from yaml import safe_load
+import os
+import glob
+import time
+import hashlib
 from charmhelpers.core.host import (
     lsb_release
 )
@@ -11,8 +14,9 @@ import subprocess
 from charmhelpers.core.hookenv import (
     config,
     log,
+    load_state,
+    save_state,
 )
-import apt_pkg
 
 CLOUD_ARCHIVE = """# Ubuntu Cloud Archive
 deb http://ubuntu-cloud.archive.canonical.com/ubuntu {} main
@@ -48,20 +52,81 @@ CLOUD_ARCHIVE_POCKETS = {
 }
 
 
+DPKG_STATUS = '/var/lib/dpkg/status'
+APT_PROXY_CONF = '/etc/apt/apt.conf.d/90charm-proxy'
+# apt sources and keyrings, any change to which requires an apt-get update
+APT_SOURCES = ['/etc/apt/sources.list', '/etc/apt/sources.list.d/*.list',
+               '/etc/apt/trusted.gpg', '/etc/apt/trusted.gpg.d/*.gpg']
+# dpkg states in which a package has no installed version
+NOT_INSTALLED = ('not-installed', 'config-files')
+
+# the index most recently loaded, with the status file stat it was built for
+_installed_index = {}
+
+
+def _read_dpkg_status(path):
+    """Stream the dpkg status file, returning installed package versions"""
+    packages = {}
+    fields = {}
+    with open(path) as status:
+        for line in status:
+            if not line.strip():
+                _add_installed(packages, fields)
+                fields = {}
+            elif not line[0].isspace() and ':' in line:
+                key, value = line.split(':', 1)
+                if key in ('Package', 'Status', 'Version'):
+                    fields[key] = value.strip()
+    _add_installed(packages, fields)
+    return packages
+
+
+def _add_installed(packages, fields):
+    state = fields.get('Status', '').split()
+    if ('Package' in fields and 'Version' in fields and state and
+            state[-1] not in NOT_INSTALLED):
+        packages[fields['Package']] = fields['Version']
+
+
+def installed_packages(status_path=DPKG_STATUS):
+    """Returns a dict of installed package names to versions.
+
+    The index is built from the dpkg status file rather than the apt cache
+    and kept in unit state until the status file's mtime or size changes.
+    It is empty where there is no status file, eg. off the unit.
+    """
+    try:
+        st = os.stat(status_path)
+    except OSError:
+        return {}
+    stamp = [status_path, st.st_mtime, st.st_size]
+    if _installed_index.get('stamp') == stamp:
+        return _installed_index['packages']
+    index = load_state('dpkg-status-index')
+    if not index or index.get('stamp') != stamp:
+        index = {'stamp': stamp, 'packages': _read_dpkg_status(status_path)}
+        save_state('dpkg-status-index', index)
+    _installed_index.update(index)
+    return index['packages']
+
+
+def installed_version(package):
+    """Returns the installed version of package, or None"""
+    return installed_packages().get(package)
+
+
+def upstream_version(version):
+    """Strips the epoch and Debian revision from a package version"""
+    version = version.split(':', 1)[-1]
+    if '-' in version:
+        version = version.rsplit('-', 1)[0]
+    return version
+
+
 def filter_installed_packages(packages):
     """Returns a list of packages that require installation"""
-    apt_pkg.init()
-    cache = apt_pkg.Cache()
-    _pkgs = []
-    for package in packages:
-        try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
-        except KeyError:
-            log('Package {} has no installation candidate.'.format(package),
-                level='WARNING')
-            _pkgs.append(package)
-    return _pkgs
+    installed = installed_packages()
+    return [p for p in packages if p not in installed]
 
 
 def apt_install(packages, options=None, fatal=False):
@@ -82,13 +147,61 @@ def apt_install(packages, options=None, fatal=False):
         subprocess.call(cmd)
 
 
-def apt_update(fatal=False):
-    """Update local apt cache"""
+def configure_apt_proxy(proxy, conf=APT_PROXY_CONF):
+    """Send apt's http requests through proxy, or directly when proxy is
+    empty.  Returns True if the apt configuration changed."""
+    content = 'Acquire::http::Proxy "{}";\n'.format(proxy) if proxy else None
+    try:
+        with open(conf) as f:
+            current = f.read()
+    except IOError:
+        current = None
+    if current == content:
+        return False
+    if content is None:
+        log('Removing apt proxy configuration')
+        os.unlink(conf)
+    else:
+        log('Configuring apt to use proxy {}'.format(proxy))
+        with open(conf + '.tmp', 'w') as f:
+            f.write(content)
+        os.rename(conf + '.tmp', conf)
+    return True
+
+
+def sources_fingerprint():
+    """Returns a digest of the configured apt sources and keys"""
+    digest = hashlib.sha256()
+    for pattern in APT_SOURCES:
+        for path in sorted(glob.glob(pattern)):
+            digest.update(path + '\0')
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def apt_update(fatal=False, max_age=None):
+    """Update local apt cache
+
+    With max_age, in seconds, the update is skipped if the apt sources and
+    keys are unchanged since an update that completed less than max_age
+    seconds ago.
+    """
+    fingerprint = sources_fingerprint()
+    if max_age:
+        last = load_state('apt-update', {})
+        if (last.get('fingerprint') == fingerprint and
+                time.time() - last.get('time', 0) < max_age):
+            log('apt sources are unchanged since the last update, '
+                'skipping apt-get update')
+            return
     cmd = ['apt-get', 'update']
     if fatal:
         subprocess.check_call(cmd)
-    else:
-        subprocess.call(cmd)
+    elif subprocess.call(cmd):
+        return
+    save_state('apt-update', {'fingerprint': fingerprint,
+                              'time': time.time()})
 
 
 def apt_purge(packages, fatal=False):
@@ -162,6 +275,7 @@ def configure_sources(update=False,
 
     Note that 'null' (a.k.a. None) should not be quoted.
     """
+    from yaml import safe_load
     sources = safe_load(config(sources_var))
     keys = config(keys_var)
     if keys is not None:
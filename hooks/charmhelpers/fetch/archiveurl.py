@@ -1,14 +1,70 @@
 import os
+import shutil
+import hashlib
 import urllib2
+from urlparse import parse_qs
 from charmhelpers.fetch import (
     BaseFetchHandler,
     UnhandledSource
 )
 from charmhelpers.payload.archive import (
+    archive_dest_default,
     get_archive_handler,
     extract,
 )
 from charmhelpers.core.host import mkdir
+from charmhelpers.core.hookenv import log
+
+CHUNK_SIZE = 64 * 1024
+# checksums that may be given as url fragment options, eg. #sha256=...
+CHECKSUMS = ('sha256', 'md5')
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def _hashes(checksums):
+    return dict((name, hashlib.new(name)) for name in checksums)
+
+
+def _hash_file(path, hashes):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            for h in hashes.itervalues():
+                h.update(chunk)
+
+
+def _validator(response):
+    """The ETag or Last-Modified header of response, for If-Range"""
+    headers = response.info()
+    etag = headers.get('ETag')
+    # weak validators are not allowed in If-Range
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def _unlink(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _check(hashes, checksums):
+    for name, expected in checksums.iteritems():
+        if hashes[name].hexdigest() != expected.lower():
+            raise ChecksumError('{} checksum mismatch: expected {}, got '
+                                '{}'.format(name, expected,
+                                            hashes[name].hexdigest()))
 
 
 class ArchiveUrlFetchHandler(BaseFetchHandler):
@@ -21,17 +77,89 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
             return True
         return False
 
-    def download(self, source, dest):
+    def checksums(self, source):
+        """Return the checksums given as url fragment options"""
+        options = parse_qs(self.parse_url(source).fragment)
+        return dict((name, options[name][-1])
+                    for name in CHECKSUMS if name in options)
+
+    def download(self, source, dest, checksums=None):
+        """Stream source to dest, verifying checksums as it is written.
+
+        The download is written to dest.part, which is kept if the transfer
+        is interrupted.  Next time it is resumed with a Range request whose
+        If-Range carries the ETag or Last-Modified of the interrupted
+        response, so a source that changed meanwhile is downloaded again
+        in full rather than appended to the old part.  Without either
+        header the download always starts again.
+        """
         # propogate all exceptions
         # URLError, OSError, etc
-        response = urllib2.urlopen(source)
+        checksums = checksums or {}
+        partial = dest + '.part'
+        validator_path = partial + '.validator'
+        hashes = _hashes(checksums)
+        offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+        validator = _read(validator_path)
+        request = urllib2.Request(source)
+        if offset and validator:
+            request.add_header('Range', 'bytes={}-'.format(offset))
+            request.add_header('If-Range', validator)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if not offset or not validator or e.code != 416:
+                raise
+            # the partial file is no prefix of the source; start again
+            _unlink(partial, validator_path)
+            return self.download(source, dest, checksums)
+        try:
+            if (offset and validator and
+                    getattr(response, 'code', None) == 206):
+                log('Resuming download of {} at byte {}'.format(source,
+                                                                offset))
+                _hash_file(partial, hashes)
+                mode = 'ab'
+            else:
+                mode = 'wb'
+                _unlink(validator_path)
+                validator = _validator(response)
+                if validator:
+                    with open(validator_path, 'w') as f:
+                        f.write(validator)
+            with open(partial, mode) as dest_file:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                    for h in hashes.itervalues():
+                        h.update(chunk)
+                    dest_file.write(chunk)
+        finally:
+            response.close()
+        try:
+            _check(hashes, checksums)
+        except ChecksumError:
+            _unlink(partial, validator_path)
+            raise
+        os.rename(partial, dest)
+        _unlink(validator_path)
+
+    def extract(self, archive):
+        """Extract archive to its default destination.
+
+        It is extracted to a temporary directory which is then renamed into
+        place, so a directory at the destination is always a complete
+        extraction.
+        """
+        dest = archive_dest_default(archive)
+        tmp = '{}.{}.tmp'.format(dest, os.getpid())
         try:
-            with open(dest, 'w') as dest_file:
-                dest_file.write(response.read())
-        except Exception as e:
-            if os.path.isfile(dest):
-                os.unlink(dest)
-            raise e
+            extract(archive, tmp)
+            if os.path.isdir(dest):
+                shutil.rmtree(dest)
+            os.rename(tmp, dest)
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+        return dest
 
     def install(self, source):
         url_parts = self.parse_url(source)
@@ -39,10 +167,26 @@ class ArchiveUrlFetchHandler(BaseFetchHandler):
         if not os.path.exists(dest_dir):
             mkdir(dest_dir, perms=0755)
         dld_file = os.path.join(dest_dir, os.path.basename(url_parts.path))
+        checksums = self.checksums(source)
+        if checksums and os.path.isfile(dld_file):
+            hashes = _hashes(checksums)
+            _hash_file(dld_file, hashes)
+            try:
+                _check(hashes, checksums)
+            except ChecksumError:
+                pass
+            else:
+                extracted = archive_dest_default(dld_file)
+                if os.path.isdir(extracted):
+                    log('{} is already installed'.format(source))
+                    return extracted
+                return self.extract(dld_file)
         try:
-            self.download(source, dld_file)
+            self.download(source, dld_file, checksums)
         except urllib2.URLError as e:
             raise UnhandledSource(e.reason)
         except OSError as e:
             raise UnhandledSource(e.strerror)
-        return extract(dld_file)
+        except ChecksumError as e:
+            raise UnhandledSource(str(e))
+        return self.extract(dld_file)
@@ -1,35 +1,59 @@
 #!/usr/bin/python
+import os
 import sys
 
+if __name__ == '__main__':
+    # Hand the hook to this unit's hook server, when one is running, before
+    # paying for the imports below.
+    from charmhelpers.core.hookserver import run_client
+    _status = run_client(sys.argv)
+    if _status is not None:
+        sys.exit(_status)
+
 from glance_utils import (
+    configure_package_sources,
     do_openstack_upgrade,
     ensure_ceph_pool,
     migrate_database,
     register_configs,
     restart_map,
+    run_pending_restarts,
+    schedule_restarts,
+    LazyConfigs,
     CLUSTER_RES,
+    CONFIG_FILES,
     PACKAGES,
     SERVICES,
     CHARM,
+    APT_CONFIG_KEYS,
+    HA_CONFIG_KEYS,
+    HTTPS_CONFIG_KEYS,
+    UNRENDERED_CONFIG_KEYS,
+    RELATION_INTERFACES,
     GLANCE_REGISTRY_CONF,
-    GLANCE_REGISTRY_PASTE_INI,
-    GLANCE_API_CONF,
-    GLANCE_API_PASTE_INI,
-    HAPROXY_CONF,
-    CEPH_CONF, )
+    GLANCE_API_CONF, )
 
 from charmhelpers.core.hookenv import (
     config,
+    config_changed_keys,
+    save_config_fingerprint,
+    load_state,
+    save_state_on_success,
     Hooks,
     log as juju_log,
     open_port,
     relation_get,
     relation_set,
     relation_ids,
+    relation_type,
     service_name,
     unit_get,
     UnregisteredHookError, )
 
+from charmhelpers.core.metrics import configure as configure_metrics
+from charmhelpers.core.tracing import enable as enable_tracing
+from charmhelpers.core import hookserver
+
 from charmhelpers.core.host import (
     restart_on_change,
     service_stop,
@@ -41,7 +65,6 @@ from charmhelpers.contrib.hahelpers.cluster import (
     canonical_url, eligible_leader)
 
 from charmhelpers.contrib.openstack.utils import (
-    configure_installation_source,
     get_os_codename_package,
     openstack_upgrade_available,
     lsb_release, )
@@ -55,7 +78,33 @@ from subprocess import (
 
 hooks = Hooks()
 
-CONFIGS = register_configs()
+CONFIGS = LazyConfigs(register_configs, CONFIG_FILES)
+
+HOOK_SCRIPT = os.path.realpath(__file__)
+
+
+def skip_unchanged(*interfaces):
+    '''
+    Returns early from a relation hook when the relation data read by the
+    context generators for interfaces is unchanged since the hook last
+    completed, saving the config render and restart checksum cycle.  The
+    fingerprint is only saved if the whole hook succeeds.
+    '''
+    key = ','.join(interfaces)
+
+    def wrap(f):
+        def wrapped_f(*args):
+            fingerprint = CONFIGS.context_fingerprint(interfaces)
+            fingerprints = load_state('relation-fingerprints', {})
+            if fingerprints.get(key) == fingerprint:
+                juju_log('%s relation data read by the charm is unchanged, '
+                         'nothing to do.' % key)
+                return
+            f(*args)
+            fingerprints[key] = fingerprint
+            save_state_on_success('relation-fingerprints', fingerprints)
+        return wrapped_f
+    return wrap
 
 
 @hooks.hook('install')
@@ -67,15 +116,26 @@ def install_hook():
        src == 'distro'):
         src = 'cloud:precise-folsom'
 
-    configure_installation_source(src)
+    configure_package_sources(src)
 
-    apt_update()
+    apt_update(max_age=config('apt-update-max-age'))
     apt_install(PACKAGES)
 
     for service in SERVICES:
         service_stop(service)
 
 
+@hooks.hook('start')
+def start():
+    if config('hook-server'):
+        hookserver.start(HOOK_SCRIPT)
+
+
+@hooks.hook('stop')
+def stop():
+    hookserver.stop()
+
+
 @hooks.hook('shared-db-relation-joined')
 def db_joined():
     relation_set(database=config('database'), username=config('database-user'),
@@ -83,7 +143,8 @@ def db_joined():
 
 
 @hooks.hook('shared-db-relation-changed')
-@restart_on_change(restart_map())
+@skip_unchanged('shared-db')
+@restart_on_change(restart_map(), schedule=schedule_restarts)
 def db_changed():
     rel = get_os_codename_package("glance-common")
 
@@ -123,7 +184,7 @@ def image_service_joined(relation_id=None):
 
 
 @hooks.hook('object-store-relation-joined')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), schedule=schedule_restarts)
 def object_store_joined():
 
     if 'identity-service' not in CONFIGS.complete_contexts():
@@ -135,7 +196,7 @@ def object_store_joined():
         juju_log('swift relation incomplete')
         return
 
-    CONFIGS.write(GLANCE_API_CONF)
+    CONFIGS.write_for(['object-store'])
 
 
 @hooks.hook('ceph-relation-joined')
@@ -145,7 +206,8 @@ def ceph_joined():
 
 
 @hooks.hook('ceph-relation-changed')
-@restart_on_change(restart_map())
+@skip_unchanged('ceph', 'ceph-glance')
+@restart_on_change(restart_map(), schedule=schedule_restarts)
 def ceph_changed():
     if 'ceph' not in CONFIGS.complete_contexts():
         juju_log('ceph relation incomplete. Peer not ready?')
@@ -158,8 +220,7 @@ def ceph_changed():
         juju_log('Could not create ceph keyring: peer not ready?')
         return
 
-    CONFIGS.write(GLANCE_API_CONF)
-    CONFIGS.write(CEPH_CONF)
+    CONFIGS.write_for(['ceph', 'ceph-glance'])
 
     if eligible_leader(CLUSTER_RES):
         _config = config()
@@ -185,17 +246,14 @@ def keystone_joined(relation_id=None):
 
 
 @hooks.hook('identity-service-relation-changed')
-@restart_on_change(restart_map())
+@skip_unchanged('identity-service', 'https')
+@restart_on_change(restart_map(), schedule=schedule_restarts)
 def keystone_changed():
     if 'identity-service' not in CONFIGS.complete_contexts():
         juju_log('identity-service relation incomplete. Peer not ready?')
         return
 
-    CONFIGS.write(GLANCE_API_CONF)
-    CONFIGS.write(GLANCE_REGISTRY_CONF)
-
-    CONFIGS.write(GLANCE_API_PASTE_INI)
-    CONFIGS.write(GLANCE_REGISTRY_PASTE_INI)
+    CONFIGS.write_for(['identity-service'])
 
     # Configure any object-store / swift relations now that we have an
     # identity-service
@@ -207,14 +265,35 @@ def keystone_changed():
 
 
 @hooks.hook('config-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), schedule=schedule_restarts)
 def config_changed():
-    if openstack_upgrade_available('glance-common'):
+    changed = config_changed_keys()
+    if changed & set(APT_CONFIG_KEYS):
+        configure_package_sources(config('openstack-origin'))
+        apt_update(max_age=config('apt-update-max-age'))
+
+    if ('openstack-origin' in changed and
+            openstack_upgrade_available('glance-common')):
         juju_log('Upgrading OpenStack release')
         do_openstack_upgrade(CONFIGS)
 
     open_port(9292)
-    configure_https()
+    if changed - set(UNRENDERED_CONFIG_KEYS):
+        CONFIGS.write_all()
+    if changed & set(HTTPS_CONFIG_KEYS):
+        configure_https()
+
+    if changed & set(HA_CONFIG_KEYS):
+        for r_id in relation_ids('ha'):
+            ha_relation_joined(relation_id=r_id)
+
+    if 'hook-server' in changed:
+        if config('hook-server'):
+            hookserver.start(HOOK_SCRIPT)
+        else:
+            hookserver.stop()
+
+    save_config_fingerprint()
 
     #env_vars = {'OPENSTACK_PORT_MCASTPORT': config("ha-mcastport"),
     #            'OPENSTACK_SERVICE_API': "glance-api",
@@ -223,19 +302,25 @@ def config_changed():
 
 
 @hooks.hook('cluster-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), schedule=schedule_restarts)
 def cluster_changed():
-    CONFIGS.write(GLANCE_API_CONF)
-    CONFIGS.write(HAPROXY_CONF)
+    CONFIGS.write_for(['cluster'])
 
 
 @hooks.hook('upgrade-charm')
+@restart_on_change(restart_map(), schedule=schedule_restarts)
 def upgrade_charm():
-    cluster_changed()
+    # the new charm's templates may differ even though no config key did,
+    # so config-changed cannot be relied on to render them
+    CONFIGS.write_all()
+    # the hook server must be restarted to load the new charm code
+    if hookserver.running():
+        hookserver.stop()
+        hookserver.start(HOOK_SCRIPT)
 
 
 @hooks.hook('ha-relation-joined')
-def ha_relation_joined():
+def ha_relation_joined(relation_id=None):
     corosync_bindiface = config("ha-bindiface")
     corosync_mcastport = config("ha-mcastport")
     vip = config("vip")
@@ -260,7 +345,8 @@ def ha_relation_joined():
     clones = {
         'cl_glance_haproxy': 'res_glance_haproxy', }
 
-    relation_set(init_services=init_services,
+    relation_set(relation_id=relation_id,
+                 init_services=init_services,
                  corosync_bindiface=corosync_bindiface,
                  corosync_mcastport=corosync_mcastport,
                  resources=resources,
@@ -290,7 +376,11 @@ def ha_relation_changed():
             'object-store-relation-broken',
             'shared-db-relation-broken')
 def relation_broken():
-    CONFIGS.write_all()
+    interfaces = RELATION_INTERFACES.get(relation_type())
+    if interfaces:
+        CONFIGS.write_for(interfaces)
+    else:
+        CONFIGS.write_all()
 
 
 def configure_https():
@@ -299,7 +389,8 @@ def configure_https():
     identity-service and image-service with any required
     updates
     '''
-    CONFIGS.write_all()
+    # https moves the api and haproxy ports
+    CONFIGS.write_for(['https', 'cluster'])
     if 'https' in CONFIGS.complete_contexts():
         cmd = ['a2ensite', 'openstack_https_frontend']
         check_call(cmd)
@@ -320,14 +411,47 @@ def amqp_joined():
 
 
 @hooks.hook('amqp-relation-changed')
-@restart_on_change(restart_map())
+@skip_unchanged('amqp')
+@restart_on_change(restart_map(), schedule=schedule_restarts)
 def amqp_changed():
     if 'amqp' not in CONFIGS.complete_contexts():
         juju_log('amqp relation incomplete. Peer not ready?')
         return
-    CONFIGS.write(GLANCE_API_CONF)
+    CONFIGS.write_for(['amqp'])
+
+
+@hooks.after
+def resume_restarts():
+    '''
+    Runs after every hook: restarts deferred by schedule_restarts happen in
+    the first hook after the unit's turn comes, or after restart-timeout.
+    Peers' restart requests only change in cluster relation hooks.
+    '''
+    if relation_type() == 'cluster' or load_state('pending-restarts'):
+        run_pending_restarts()
+
+
+def configure_diagnostics():
+    if config('hook-trace'):
+        enable_tracing()
+    if config('metrics-textfile-dir'):
+        configure_metrics(config('metrics-textfile-dir'))
+
+
+def reset_hook_state():
+    '''
+    Run by the hook server before each hook, which it executes in a child
+    forked from a process that imported this module for an earlier hook.
+    '''
+    CONFIGS.reset()
+    configure_diagnostics()
+
 
 if __name__ == '__main__':
+    if hookserver.SERVE_ARG in sys.argv[1:]:
+        hookserver.serve(hooks, setup=reset_hook_state)
+        sys.exit(0)
+    configure_diagnostics()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
 import os
+import time
+import urllib2
 import subprocess
 
 import glance_contexts
@@ -9,14 +11,28 @@ from collections import OrderedDict
 
 from charmhelpers.fetch import (
     apt_install,
-    apt_update, )
+    apt_update,
+    configure_apt_proxy, )
 
 from charmhelpers.core.hookenv import (
     config,
+    load_state,
+    local_unit,
     log,
-    relation_ids)
-
-from charmhelpers.core.host import mkdir
+    related_units,
+    relation_get,
+    relation_ids,
+    relation_set,
+    save_state,
+    save_state_on_success,
+    WARNING)
+
+from charmhelpers.core.host import (
+    atomic_files,
+    service_update,
+    GRACEFUL,
+    HANDOFF,
+    RESTART, )
 
 from charmhelpers.contrib.openstack import (
     templating,
@@ -31,6 +47,7 @@ from charmhelpers.contrib.storage.linux.ceph import (
     pool_exists as ceph_pool_exists)
 
 from charmhelpers.contrib.openstack.utils import (
+    cloud_archive_pocket,
     get_os_codename_install_source,
     get_os_codename_package,
     configure_installation_source, )
@@ -58,8 +75,52 @@ HTTPS_APACHE_24_CONF = "/etc/apache2/sites-available/" \
 
 CONF_DIR = "/etc/glance"
 
+# Charm config keys that change the endpoint URLs published to keystone and
+# image-service clients or the https frontend.
+HTTPS_CONFIG_KEYS = ['ssl_cert', 'ssl_key', 'vip', 'region']
+
+# Charm config keys passed to hacluster when the ha relation is joined.
+HA_CONFIG_KEYS = ['vip', 'vip_iface', 'vip_cidr', 'ha-bindiface',
+                  'ha-mcastport']
+
+# Charm config keys that change where packages are downloaded from.
+APT_CONFIG_KEYS = ['apt-proxy', 'cloud-archive-mirror']
+
+# Context interfaces whose config files can change with each relation's data.
+# identity-service also decides whether the https frontend is enabled, which
+# moves the api and haproxy ports of the cluster contexts.
+RELATION_INTERFACES = {
+    'amqp': ['amqp'],
+    'ceph': ['ceph', 'ceph-glance'],
+    'cluster': ['cluster'],
+    'identity-service': ['identity-service', 'https', 'cluster'],
+    'object-store': ['object-store'],
+    'shared-db': ['shared-db'],
+}
+
+# Charm config keys that are not read by any template context.
+UNRENDERED_CONFIG_KEYS = ['openstack-origin', 'ceph-osd-replication-count',
+                          'vip_iface', 'vip_cidr', 'ha-bindiface',
+                          'ha-mcastport', 'hook-trace',
+                          'metrics-textfile-dir', 'hook-server',
+                          'apt-update-max-age', 'render-workers',
+                          'restart-batch-size', 'restart-timeout'] + \
+    APT_CONFIG_KEYS
+
 TEMPLATES = 'templates/'
 
+# Services behind haproxy whose restarts are staggered across the cluster,
+# see schedule_restarts.
+ROLLING_SERVICES = ['glance-api', 'glance-registry']
+
+# How services pick up changed config, see charmhelpers.core.host; others
+# are restarted.  Reloading haproxy and apache2 keeps in-flight image
+# transfers going.
+SERVICE_STRATEGIES = {
+    'haproxy': HANDOFF,
+    'apache2': GRACEFUL,
+}
+
 CONFIG_FILES = OrderedDict([
     (GLANCE_REGISTRY_CONF, {
         'hook_contexts': [context.SharedDBContext(),
@@ -108,8 +169,9 @@ def register_configs():
     # Regstration of some configs may not be required depending on
     # existing of certain relations.
     release = get_os_codename_package('glance-common', fatal=False) or 'essex'
-    configs = templating.OSConfigRenderer(templates_dir=TEMPLATES,
-                                          openstack_release=release)
+    configs = templating.OSConfigRenderer(
+        templates_dir=TEMPLATES, openstack_release=release,
+        workers=config('render-workers') or 1)
 
     confs = [GLANCE_REGISTRY_CONF,
              GLANCE_API_CONF,
@@ -117,8 +179,8 @@ def register_configs():
              GLANCE_REGISTRY_PASTE_INI,
              HAPROXY_CONF]
 
+    # /etc/ceph is created by CephContext.apply before ceph.conf is written
     if relation_ids('ceph'):
-        mkdir('/etc/ceph')
         confs.append(CEPH_CONF)
 
     for conf in confs:
@@ -134,6 +196,66 @@ def register_configs():
     return configs
 
 
+class LazyConfigs(object):
+    '''
+    Stands in for the OSConfigRenderer returned by factory, which is only
+    called when the renderer is first used.  Building it reads the installed
+    glance-common version from the apt cache and the ceph relation ids,
+    which most hooks never need.  The config_files the renderer may
+    register are declared up front, as restart_on_change checks them
+    before the hook first uses it.
+    '''
+    def __init__(self, factory=register_configs, config_files=()):
+        self._factory = factory
+        self._configs = None
+        atomic_files.update(config_files)
+
+    def __getattr__(self, name):
+        if self._configs is None:
+            self._configs = self._factory()
+        return getattr(self._configs, name)
+
+    def reset(self):
+        '''Rebuild the renderer on next use'''
+        self._configs = None
+
+
+def mirror_available(mirror, src, proxy=None):
+    '''
+    Checks that mirror serves the Release file of the Cloud Archive pocket
+    of installation source src, fetching it through proxy if given.
+    '''
+    pocket = cloud_archive_pocket(src)
+    if not pocket:
+        # only Cloud Archive pockets are fetched from the mirror
+        return True
+    opener = urllib2.build_opener(
+        urllib2.ProxyHandler({'http': proxy} if proxy else {}))
+    url = '%s/dists/%s/Release' % (mirror.rstrip('/'), pocket)
+    try:
+        opener.open(url, timeout=10).close()
+    except (urllib2.URLError, IOError) as e:
+        log('Cloud archive mirror check of %s failed: %s' % (url, e),
+            level=WARNING)
+        return False
+    return True
+
+
+def configure_package_sources(src):
+    '''
+    Configures the apt proxy and installation source src, fetching Cloud
+    Archive pockets from the cloud-archive-mirror when it serves them.
+    '''
+    proxy = config('apt-proxy')
+    configure_apt_proxy(proxy)
+    mirror = config('cloud-archive-mirror') or None
+    if mirror and not mirror_available(mirror, src, proxy):
+        log('Installing from the Cloud Archive instead of %s' % mirror,
+            level=WARNING)
+        mirror = None
+    configure_installation_source(src, mirror=mirror)
+
+
 def migrate_database():
     '''Runs glance-manage to initialize a new database or migrate existing'''
     cmd = ['glance-manage', 'db_sync']
@@ -161,12 +283,12 @@ def do_openstack_upgrade(configs):
 
     log('Performing OpenStack upgrade to %s.' % (new_os_rel))
 
-    configure_installation_source(new_src)
+    configure_package_sources(new_src)
     dpkg_opts = [
         '--option', 'Dpkg::Options::=--force-confnew',
         '--option', 'Dpkg::Options::=--force-confdef',
     ]
-    apt_update()
+    apt_update(max_age=config('apt-update-max-age'))
     apt_install(packages=PACKAGES, options=dpkg_opts, fatal=True)
 
     # set CONFIGS to load templates from new release and regenerate config
@@ -183,13 +305,164 @@ def restart_map():
     charmhelpers.core.restart_on_change() based on the services configured.
 
     :returns: dict: A dictionary mapping config file to lists of services
-                    that should be restarted when file changes.
+                    that should be restarted when file changes, given as
+                    (service, strategy) for those in SERVICE_STRATEGIES.
     '''
     _map = []
     for f, ctxt in CONFIG_FILES.iteritems():
         svcs = []
         for svc in ctxt['services']:
+            if svc in SERVICE_STRATEGIES:
+                svc = (svc, SERVICE_STRATEGIES[svc])
             svcs.append(svc)
         if svcs:
             _map.append((f, svcs))
     return OrderedDict(_map)
+
+
+def _token_time(token):
+    '''
+    Returns the time a restart-request token was issued at, or None if it
+    is not one.
+    '''
+    try:
+        return float(token)
+    except (TypeError, ValueError):
+        return None
+
+
+def restart_queue():
+    '''
+    Returns the units with a restart pending, this one included, as
+    (token, unit) in the order they restart: by the time of the
+    restart-request token they published on the cluster relation, then by
+    name.  A unit's restart is done once it publishes restart-done with
+    the same token.  Peers publishing tokens that are not times are left
+    out, rather than holding up the others.
+    '''
+    queue = []
+    pending = load_state('pending-restarts')
+    if pending:
+        queue.append((pending['token'], local_unit()))
+    for r_id in relation_ids('cluster'):
+        for unit in related_units(r_id):
+            token = relation_get('restart-request', rid=r_id, unit=unit)
+            done = relation_get('restart-done', rid=r_id, unit=unit)
+            if not token or token == done:
+                continue
+            if _token_time(token) is None:
+                log('Ignoring restart request %r of %s' % (token, unit),
+                    level=WARNING)
+                continue
+            queue.append((token, unit))
+    return sorted(queue, key=lambda entry: (_token_time(entry[0]), entry[1]))
+
+
+def _publish_restart_queue(queue):
+    '''
+    Publishes the restart queue as this unit sees it, which acknowledges
+    the peers' requests and wakes them up to check their turn.
+    '''
+    seen = ' '.join('%s=%s' % (unit, token) for token, unit in queue)
+    if seen == load_state('restart-queue', ''):
+        return
+    for r_id in relation_ids('cluster'):
+        relation_set(relation_id=r_id, **{'restart-queue': seen})
+    save_state_on_success('restart-queue', seen)
+
+
+def _request_restart(token):
+    '''
+    Publishes this unit's restart request to its peers.  It is recorded as
+    published once the hook's relation settings are written, so the next
+    hook publishes it again if this one fails.
+    '''
+    for r_id in relation_ids('cluster'):
+        relation_set(relation_id=r_id, **{'restart-request': token})
+    save_state_on_success('restart-requested', token)
+
+
+def _acknowledged(token):
+    '''
+    Returns whether every peer has seen this unit's restart request, so
+    that all of them order it the same way.
+    '''
+    request = '%s=%s' % (local_unit(), token)
+    for r_id in relation_ids('cluster'):
+        for unit in related_units(r_id):
+            seen = relation_get('restart-queue', rid=r_id, unit=unit) or ''
+            if request not in seen.split():
+                return False
+    return True
+
+
+def run_pending_restarts():
+    '''
+    Restarts the services deferred by schedule_restarts once every peer has
+    acknowledged the request and fewer than restart-batch-size units are
+    ahead of this one in the restart queue, or once the unit has waited
+    restart-timeout seconds, then tells the peers.  The timeout is only
+    checked when a hook runs on the unit.  Without peers, eg. once they
+    have departed, the services are restarted straight away.
+    '''
+    pending = load_state('pending-restarts')
+    if pending and _token_time(pending['token']) is None:
+        log('Discarding restart token %r' % pending['token'], level=WARNING)
+        pending['token'] = '%.6f' % time.time()
+        save_state('pending-restarts', pending)
+    queue = restart_queue()
+    _publish_restart_queue(queue)
+    if not pending:
+        return
+    services = ' '.join(pending['services'])
+    peers = [unit for r_id in relation_ids('cluster')
+             for unit in related_units(r_id)]
+    if peers:
+        if load_state('restart-requested') != pending['token']:
+            _request_restart(pending['token'])
+        position = [unit for _, unit in queue].index(local_unit())
+        waited = time.time() - _token_time(pending['token'])
+        if (position >= max(config('restart-batch-size'), 1) or
+                not _acknowledged(pending['token'])):
+            if waited < config('restart-timeout'):
+                log('Deferring restart of %s, %d peers restart first' %
+                    (services, position))
+                return
+            log('Restarting %s after waiting %ds for peers' %
+                (services, waited), level=WARNING)
+    for service in pending['services']:
+        service_update(service, RESTART)
+    # kept until the peers are told, so a failed hook restarts them again
+    save_state_on_success('pending-restarts', None)
+    for r_id in relation_ids('cluster'):
+        relation_set(relation_id=r_id, **{'restart-done': pending['token']})
+    _publish_restart_queue(restart_queue())
+
+
+def schedule_restarts(updates):
+    '''
+    Schedule for restart_on_change: restarts of ROLLING_SERVICES are queued
+    on the cluster relation, so that no more than restart-batch-size units
+    restart them at a time and haproxy keeps healthy backends.  The unit
+    restarts them in a later hook, see run_pending_restarts.  The other
+    updates, and all of them without peers or with a batch size of 0, are
+    returned to be done now.
+    '''
+    rolling = [service for service, strategy in updates.iteritems()
+               if service in ROLLING_SERVICES and strategy == RESTART]
+    peers = [unit for r_id in relation_ids('cluster')
+             for unit in related_units(r_id)]
+    if not rolling or not peers or not config('restart-batch-size'):
+        return updates
+    pending = load_state('pending-restarts') or {}
+    if not pending:
+        pending['token'] = '%.6f' % time.time()
+        _request_restart(pending['token'])
+    pending['services'] = sorted(set(pending.get('services', []) + rolling))
+    # stored now: the changed config files are not seen to change again
+    # when the hook is retried
+    save_state('pending-restarts', pending)
+    log('Queued restart of %s' % ' '.join(rolling))
+    return OrderedDict((service, strategy)
+                       for service, strategy in updates.iteritems()
+                       if service not in rolling)
@@ -0,0 +1,166 @@
+import os
+import shutil
+import hashlib
+import tempfile
+
+from mock import patch
+
+from charmhelpers.fetch import UnhandledSource
+from charmhelpers.fetch import archiveurl
+
+from test_utils import (
+    CharmTestCase,
+    http_server,
+)
+
+TO_PATCH = [
+    'extract',
+    'log',
+    'mkdir',
+]
+
+PAYLOAD = ''.join(chr(i % 251) for i in range(300 * 1024))
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+MD5 = hashlib.md5(PAYLOAD).hexdigest()
+# the ETag http_server sends for PAYLOAD
+ETAG = '"{}"'.format(MD5)
+
+
+class ArchiveUrlFetchHandlerTests(CharmTestCase):
+
+    def setUp(self):
+        super(ArchiveUrlFetchHandlerTests, self).setUp(archiveurl, TO_PATCH)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.handler = archiveurl.ArchiveUrlFetchHandler()
+        self.source = os.path.join(self.tmp, 'payload.tgz')
+        with open(self.source, 'wb') as f:
+            f.write(PAYLOAD)
+        self.dest = os.path.join(self.tmp, 'fetched.tgz')
+        self.extract.side_effect = self.fake_extract
+
+    def fake_extract(self, archive, dest):
+        os.makedirs(os.path.join(dest, 'payload'))
+
+    def read_dest(self):
+        with open(self.dest, 'rb') as f:
+            return f.read()
+
+    def test_checksums(self):
+        self.assertEquals(
+            self.handler.checksums('http://x/a.tgz#sha256=ab&md5=cd&x=1'),
+            {'sha256': 'ab', 'md5': 'cd'})
+        self.assertEquals(self.handler.checksums('http://x/a.tgz'), {})
+
+    def test_download_file_url(self):
+        self.handler.download('file://' + self.source, self.dest,
+                              {'sha256': SHA256, 'md5': MD5})
+        self.assertEquals(self.read_dest(), PAYLOAD)
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+    def test_download_checksum_mismatch(self):
+        self.assertRaises(archiveurl.ChecksumError, self.handler.download,
+                          'file://' + self.source, self.dest,
+                          {'sha256': hashlib.sha256('x').hexdigest()})
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+
+    def write_partial(self, content, validator=ETAG):
+        with open(self.dest + '.part', 'wb') as f:
+            f.write(content)
+        if validator:
+            with open(self.dest + '.part.validator', 'w') as f:
+                f.write(validator)
+
+    def test_download_resumes_partial_file(self):
+        self.write_partial(PAYLOAD[:100000])
+        with http_server({'/payload.tgz': PAYLOAD}) as (url, requested):
+            self.handler.download(url + '/payload.tgz', self.dest,
+                                  {'sha256': SHA256})
+        self.assertEquals(self.read_dest(), PAYLOAD)
+        self.log.assert_called_with(
+            'Resuming download of {}/payload.tgz at byte 100000'.format(url))
+        self.assertFalse(os.path.exists(self.dest + '.part.validator'))
+
+    def test_download_restarts_changed_source(self):
+        self.write_partial('stale', validator='"old"')
+        with http_server({'/payload.tgz': PAYLOAD}) as (url, requested):
+            self.handler.download(url + '/payload.tgz', self.dest)
+        self.assertEquals(self.read_dest(), PAYLOAD)
+        self.assertFalse(self.log.called)
+
+    def test_download_restarts_without_validator(self):
+        self.write_partial('stale', validator=None)
+        with http_server({'/payload.tgz': PAYLOAD}) as (url, requested):
+            self.handler.download(url + '/payload.tgz', self.dest)
+        self.assertEquals(self.read_dest(), PAYLOAD)
+        self.assertEquals(len(requested), 1)
+        self.assertFalse(self.log.called)
+
+    def test_download_keeps_validator_of_interrupted_transfer(self):
+        with http_server({'/payload.tgz': PAYLOAD}) as (url, requested):
+            with patch.object(archiveurl, 'CHUNK_SIZE', 1024):
+                with patch.object(archiveurl.hashlib, 'new') as new:
+                    new.return_value.update.side_effect = [None, IOError]
+                    self.assertRaises(IOError, self.handler.download,
+                                      url + '/payload.tgz', self.dest,
+                                      {'sha256': SHA256})
+        self.assertEquals(os.path.getsize(self.dest + '.part'), 1024)
+        with open(self.dest + '.part.validator') as f:
+            self.assertEquals(f.read(), ETAG)
+
+    def test_download_restarts_oversized_partial_file(self):
+        self.write_partial(PAYLOAD + 'trailing')
+        with http_server({'/payload.tgz': PAYLOAD}) as (url, requested):
+            self.handler.download(url + '/payload.tgz', self.dest,
+                                  {'sha256': SHA256})
+        self.assertEquals(self.read_dest(), PAYLOAD)
+        self.assertEquals(len(requested), 2)
+
+    @patch.dict(os.environ)
+    def test_install_verifies_checksum(self):
+        os.environ['CHARM_DIR'] = self.tmp
+        os.mkdir(os.path.join(self.tmp, 'fetched'))
+        with http_server({'/payload.tgz': PAYLOAD}) as (url, requested):
+            self.assertRaises(UnhandledSource, self.handler.install,
+                              url + '/payload.tgz#md5=' + MD5[::-1])
+            self.handler.install(url + '/payload.tgz#md5=' + MD5)
+        self.extract.assert_called_with(
+            os.path.join(self.tmp, 'fetched', 'payload.tgz'),
+            os.path.join(self.tmp, 'archives',
+                         'payload.tgz.{}.tmp'.format(os.getpid())))
+        self.assertTrue(os.path.isdir(os.path.join(self.tmp, 'archives',
+                                                   'payload.tgz')))
+
+    @patch.dict(os.environ)
+    def test_install_skips_unchanged_payload(self):
+        os.environ['CHARM_DIR'] = self.tmp
+        os.mkdir(os.path.join(self.tmp, 'fetched'))
+        shutil.copy(self.source, os.path.join(self.tmp, 'fetched'))
+        os.makedirs(os.path.join(self.tmp, 'archives', 'payload.tgz'))
+        with patch.object(self.handler, 'download') as download:
+            self.assertEquals(
+                self.handler.install('http://127.0.0.1:9/payload.tgz'
+                                     '#sha256=' + SHA256),
+                os.path.join(self.tmp, 'archives', 'payload.tgz'))
+            self.assertFalse(download.called)
+        self.assertFalse(self.extract.called)
+
+    @patch.dict(os.environ)
+    def test_install_interrupted_extraction(self):
+        os.environ['CHARM_DIR'] = self.tmp
+        os.mkdir(os.path.join(self.tmp, 'fetched'))
+        shutil.copy(self.source, os.path.join(self.tmp, 'fetched'))
+
+        def interrupted(archive, dest):
+            os.makedirs(os.path.join(dest, 'partial'))
+            raise IOError('interrupted')
+
+        self.extract.side_effect = interrupted
+        source = 'http://127.0.0.1:9/payload.tgz#sha256=' + SHA256
+        self.assertRaises(IOError, self.handler.install, source)
+        self.assertEquals(os.listdir(os.path.join(self.tmp, 'archives')), [])
+        # not taken for installed next time
+        self.extract.side_effect = self.fake_extract
+        dest = self.handler.install(source)
+        self.assertEquals(os.listdir(dest), ['payload'])
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from charmhelpers import fetch
+from charmhelpers.contrib.openstack.utils import get_os_codename_package
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'log',
+]
+
+STATUS = '''Package: glance-common
+Status: install ok installed
+Version: 1:2013.2-0ubuntu1~cloud0
+Description: OpenStack Image Registry and Delivery Service
+ Version: 9.9 in a description continuation line
+
+Package: glance-api
+Status: deinstall ok config-files
+Version: 1:2013.2-0ubuntu1~cloud0
+
+Package: haproxy
+Status: install ok installed
+Version: 1.4.24-2
+'''
+
+
+class InstalledPackagesTests(CharmTestCase):
+
+    def setUp(self):
+        super(InstalledPackagesTests, self).setUp(fetch, TO_PATCH)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        _env = patch.dict(os.environ, {'CHARM_STATE_DIR': self.tmp})
+        _env.start()
+        self.addCleanup(_env.stop)
+        self.addCleanup(fetch._installed_index.clear)
+        fetch._installed_index.clear()
+        self.status = os.path.join(self.tmp, 'status')
+        with open(self.status, 'w') as f:
+            f.write(STATUS)
+
+    def test_installed_packages(self):
+        self.assertEquals(fetch.installed_packages(self.status), {
+            'glance-common': '1:2013.2-0ubuntu1~cloud0',
+            'haproxy': '1.4.24-2'})
+
+    def test_installed_packages_indexed_until_status_changes(self):
+        fetch.installed_packages(self.status)
+        fetch._installed_index.clear()
+        with patch.object(fetch, '_read_dpkg_status') as read:
+            fetch.installed_packages(self.status)
+            self.assertFalse(read.called)
+            with open(self.status, 'a') as f:
+                f.write('\nPackage: uuid\nStatus: install ok installed\n'
+                        'Version: 1.6.2\n')
+            read.return_value = {}
+            fetch.installed_packages(self.status)
+            read.assert_called_with(self.status)
+
+    def test_installed_packages_without_status_file(self):
+        self.assertEquals(
+            fetch.installed_packages(os.path.join(self.tmp, 'missing')), {})
+
+    def test_codename_without_status_file(self):
+        with patch.object(fetch.os, 'stat', side_effect=OSError):
+            self.assertEquals(get_os_codename_package('glance-common',
+                                                      fatal=False), None)
+
+    def test_upstream_version(self):
+        self.assertEquals(fetch.upstream_version('1:2013.2-0ubuntu1~cloud0'),
+                          '2013.2')
+        self.assertEquals(fetch.upstream_version('1.6.2'), '1.6.2')
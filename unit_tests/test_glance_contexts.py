@@ -1,4 +1,4 @@
-from mock import patch
+from mock import call, patch
 import glance_contexts as contexts
 
 from test_utils import (
@@ -54,3 +54,62 @@ class TestGlanceContexts(CharmTestCase):
                                                 https):
         https.return_value = False
         self.assertEquals(contexts.ApacheSSLContext()(), {})
+
+    @patch('charmhelpers.contrib.openstack.context.check_call')
+    @patch('charmhelpers.contrib.openstack.context.determine_api_port')
+    @patch('charmhelpers.contrib.openstack.context.is_clustered')
+    @patch('charmhelpers.contrib.openstack.context.peer_units')
+    @patch('charmhelpers.contrib.openstack.context.unit_get')
+    @patch('charmhelpers.contrib.openstack.context.https')
+    def test_apache_ssl_context_has_no_side_effects(
+            self, https, unit_get, peer_units, is_clustered,
+            determine_api_port, check_call):
+        https.return_value = True
+        unit_get.return_value = '10.0.0.1'
+        peer_units.return_value = []
+        is_clustered.return_value = False
+        determine_api_port.return_value = 9282
+        with patch.object(contexts.ApacheSSLContext,
+                          'configure_cert') as configure_cert:
+            self.assertEquals(contexts.ApacheSSLContext()(),
+                              {'namespace': 'glance',
+                               'private_address': '10.0.0.1',
+                               'endpoints': [(9292, 9282)]})
+            self.assertFalse(configure_cert.called)
+        self.assertFalse(check_call.called)
+
+    @patch('os.path.exists')
+    @patch('os.path.isdir')
+    @patch('charmhelpers.contrib.openstack.context.check_call')
+    @patch('charmhelpers.contrib.openstack.context.atomic_write')
+    @patch('charmhelpers.contrib.openstack.context.get_ca_cert')
+    @patch('charmhelpers.contrib.openstack.context.get_cert')
+    def test_apache_ssl_context_apply(self, get_cert, get_ca_cert,
+                                      atomic_write, check_call, isdir,
+                                      exists):
+        get_cert.return_value = ('Y2VydA==', 'a2V5')
+        get_ca_cert.return_value = 'Y2E='
+        isdir.return_value = True
+        exists.side_effect = lambda path: path.endswith('/ssl.load')
+        atomic_write.return_value = True
+        contexts.ApacheSSLContext().apply({'namespace': 'glance'})
+        atomic_write.assert_any_call('/etc/apache2/ssl/glance/cert', 'cert')
+        atomic_write.assert_any_call('/etc/apache2/ssl/glance/key', 'key')
+        self.assertEquals(check_call.call_args_list,
+                          [call(['update-ca-certificates']),
+                           call(['a2enmod', 'proxy', 'proxy_http'])])
+
+        # unchanged CA certificate, modules already enabled
+        check_call.reset_mock()
+        atomic_write.return_value = False
+        exists.side_effect = lambda path: True
+        contexts.ApacheSSLContext().apply({'namespace': 'glance'})
+        self.assertFalse(check_call.called)
+
+    @patch('charmhelpers.contrib.openstack.context.check_call')
+    def test_apache_ssl_context_apply_https_disabled(self, check_call):
+        with patch.object(contexts.ApacheSSLContext,
+                          'configure_cert') as configure_cert:
+            contexts.ApacheSSLContext().apply({})
+            self.assertFalse(configure_cert.called)
+        self.assertFalse(check_call.called)
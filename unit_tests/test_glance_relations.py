@@ -2,6 +2,8 @@ from mock import call, patch, MagicMock
 
 from test_utils import CharmTestCase
 
+from charmhelpers.contrib.openstack import templating
+
 import glance_utils as utils
 
 _reg = utils.register_configs
@@ -20,6 +22,10 @@ TO_PATCH = [
     'Hooks',
     'canonical_url',
     'config',
+    'config_changed_keys',
+    'save_config_fingerprint',
+    'load_state',
+    'save_state_on_success',
     'juju_log',
     'open_port',
     'relation_ids',
@@ -33,7 +39,7 @@ TO_PATCH = [
     'restart_on_change',
     'service_stop',
     # charmhelpers.contrib.openstack.utils
-    'configure_installation_source',
+    'configure_package_sources',
     'get_os_codename_package',
     'openstack_upgrade_available',
     # charmhelpers.contrib.hahelpers.cluster_utils
@@ -49,24 +55,42 @@ TO_PATCH = [
     'call',
     'check_call',
     'execd_preinstall',
+    'hookserver',
     'mkdir',
     'lsb_release'
 ]
 
 
+def config_renderer():
+    '''
+    Returns a renderer with all of glance's config files registered, which
+    records the files written instead of rendering them.  No context
+    generator is run.
+    '''
+    with patch.object(templating, 'log'):
+        configs = templating.OSConfigRenderer(utils.TEMPLATES, 'havana')
+        for config_file, spec in utils.CONFIG_FILES.iteritems():
+            configs.register(config_file, spec['hook_contexts'])
+    configs.write = MagicMock()
+    configs.complete_contexts = MagicMock()
+    configs.context_fingerprint = MagicMock()
+    return configs
+
+
 class GlanceRelationTests(CharmTestCase):
 
     def setUp(self):
         super(GlanceRelationTests, self).setUp(relations, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        self.load_state.return_value = {}
 
     def test_install_hook(self):
         repo = 'cloud:precise-grizzly'
         self.test_config.set('openstack-origin', repo)
         self.service_stop.return_value = True
         relations.install_hook()
-        self.configure_installation_source.assert_called_with(repo)
-        self.assertTrue(self.apt_update.called)
+        self.configure_package_sources.assert_called_with(repo)
+        self.apt_update.assert_called_with(max_age=3600)
         self.apt_install.assert_called_with(['apache2', 'glance',
                                              'python-mysqldb',
                                              'python-swift',
@@ -74,15 +98,40 @@ class GlanceRelationTests(CharmTestCase):
                                              'uuid', 'haproxy'])
         self.assertTrue(self.execd_preinstall.called)
 
+    def test_install_hook_order(self):
+        self.test_config.set('openstack-origin', 'cloud:precise-grizzly')
+        steps = MagicMock()
+        for step in ('execd_preinstall', 'configure_package_sources',
+                     'apt_update', 'apt_install'):
+            steps.attach_mock(getattr(self, step), step)
+        relations.install_hook()
+        # payloads may set up what configuring the sources relies on
+        self.assertEquals([name for name, _, _ in steps.mock_calls], [
+            'execd_preinstall', 'configure_package_sources', 'apt_update',
+            'apt_install'])
+
     def test_install_hook_precise_distro(self):
         self.test_config.set('openstack-origin', 'distro')
         self.lsb_release.return_value = {'DISTRIB_CODENAME': 'precise'}
         self.service_stop.return_value = True
         relations.install_hook()
-        self.configure_installation_source.assert_called_with(
+        self.configure_package_sources.assert_called_with(
             "cloud:precise-folsom"
         )
 
+    def test_start_hook_server_disabled(self):
+        relations.start()
+        self.assertFalse(self.hookserver.start.called)
+
+    def test_start_hook_server_enabled(self):
+        self.test_config.set('hook-server', True)
+        relations.start()
+        self.hookserver.start.assert_called_with(relations.HOOK_SCRIPT)
+
+    def test_stop(self):
+        relations.stop()
+        self.assertTrue(self.hookserver.stop.called)
+
     def test_db_joined(self):
         self.unit_get.return_value = 'glance.foohost.com'
         relations.db_joined()
@@ -106,6 +155,35 @@ class GlanceRelationTests(CharmTestCase):
         configs.write = MagicMock()
         relations.db_changed()
 
+    @patch.object(relations, 'CONFIGS')
+    def test_db_changed_saves_fingerprint(self, configs):
+        configs.context_fingerprint.return_value = 'abc'
+        self._shared_db_test(configs)
+        configs.context_fingerprint.assert_called_with(('shared-db',))
+        self.save_state_on_success.assert_called_with(
+            'relation-fingerprints', {'shared-db': 'abc'})
+
+    @patch.object(relations, 'CONFIGS')
+    def test_db_changed_relation_data_unchanged(self, configs):
+        configs.context_fingerprint.return_value = 'abc'
+        self.load_state.return_value = {'shared-db': 'abc'}
+        self._shared_db_test(configs)
+        self.assertFalse(configs.write.called)
+        self.assertFalse(self.migrate_database.called)
+        self.assertFalse(self.save_state_on_success.called)
+
+    @patch.object(relations, 'configure_https')
+    @patch.object(relations, 'CONFIGS')
+    def test_keystone_changed_relation_data_unchanged(self, configs,
+                                                      configure_https):
+        configs.context_fingerprint.return_value = 'abc'
+        self.load_state.return_value = {'identity-service,https': 'abc'}
+        relations.keystone_changed()
+        configs.context_fingerprint.assert_called_with(('identity-service',
+                                                        'https'))
+        self.assertFalse(configs.write.called)
+        self.assertFalse(configure_https.called)
+
     @patch.object(relations, 'CONFIGS')
     def test_db_changed_no_essex(self, configs):
         self._shared_db_test(configs)
@@ -191,7 +269,7 @@ class GlanceRelationTests(CharmTestCase):
             'swift relation incomplete'
         )
 
-    @patch.object(relations, 'CONFIGS')
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
     def test_object_store_joined_with_identity_service_with_object_store(
             self, configs):
         configs.complete_contexts = MagicMock()
@@ -228,7 +306,7 @@ class GlanceRelationTests(CharmTestCase):
             'Could not create ceph keyring: peer not ready?'
         )
 
-    @patch.object(relations, 'CONFIGS')
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
     def test_ceph_changed_with_key_and_relation_data(self, configs):
         configs.complete_contexts = MagicMock()
         configs.complete_contexts.return_value = ['ceph']
@@ -282,7 +360,7 @@ class GlanceRelationTests(CharmTestCase):
         self.assertFalse(configs.write.called)
 
     @patch.object(relations, 'configure_https')
-    @patch.object(relations, 'CONFIGS')
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
     def test_keystone_changed_no_object_store_relation(self, configs,
                                                        configure_https):
         configs.complete_contexts = MagicMock()
@@ -290,8 +368,8 @@ class GlanceRelationTests(CharmTestCase):
         configs.write = MagicMock()
         self.relation_ids.return_value = []
         relations.keystone_changed()
-        self.assertEquals([call('/etc/glance/glance-api.conf'),
-                           call('/etc/glance/glance-registry.conf'),
+        self.assertEquals([call('/etc/glance/glance-registry.conf'),
+                           call('/etc/glance/glance-api.conf'),
                            call('/etc/glance/glance-api-paste.ini'),
                            call('/etc/glance/glance-registry-paste.ini')],
                           configs.write.call_args_list)
@@ -299,7 +377,7 @@ class GlanceRelationTests(CharmTestCase):
 
     @patch.object(relations, 'configure_https')
     @patch.object(relations, 'object_store_joined')
-    @patch.object(relations, 'CONFIGS')
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
     def test_keystone_changed_with_object_store_relation(
             self, configs, object_store_joined, configure_https):
         configs.complete_contexts = MagicMock()
@@ -307,8 +385,8 @@ class GlanceRelationTests(CharmTestCase):
         configs.write = MagicMock()
         self.relation_ids.return_value = ['object-store:0']
         relations.keystone_changed()
-        self.assertEquals([call('/etc/glance/glance-api.conf'),
-                           call('/etc/glance/glance-registry.conf'),
+        self.assertEquals([call('/etc/glance/glance-registry.conf'),
+                           call('/etc/glance/glance-api.conf'),
                            call('/etc/glance/glance-api-paste.ini'),
                            call('/etc/glance/glance-registry-paste.ini')],
                           configs.write.call_args_list)
@@ -317,13 +395,18 @@ class GlanceRelationTests(CharmTestCase):
 
     @patch.object(relations, 'configure_https')
     def test_config_changed_no_openstack_upgrade(self, configure_https):
+        self.config_changed_keys.return_value = set(['openstack-origin',
+                                                     'ssl_cert'])
         self.openstack_upgrade_available.return_value = False
         relations.config_changed()
         self.open_port.assert_called_with(9292)
         self.assertTrue(configure_https.called)
+        self.assertTrue(self.save_config_fingerprint.called)
 
     @patch.object(relations, 'configure_https')
     def test_config_changed_with_openstack_upgrade(self, configure_https):
+        self.config_changed_keys.return_value = set(['openstack-origin',
+                                                     'ssl_cert'])
         self.openstack_upgrade_available.return_value = True
         relations.config_changed()
         self.juju_log.assert_called_with(
@@ -332,7 +415,67 @@ class GlanceRelationTests(CharmTestCase):
         self.assertTrue(self.do_openstack_upgrade.called)
         self.assertTrue(configure_https.called)
 
+    @patch.object(relations, 'configure_https')
+    @patch.object(relations, 'CONFIGS')
+    def test_config_changed_origin_unchanged(self, configs, configure_https):
+        self.config_changed_keys.return_value = set(['region'])
+        relations.config_changed()
+        self.assertFalse(self.openstack_upgrade_available.called)
+        self.assertFalse(self.do_openstack_upgrade.called)
+        self.assertTrue(configure_https.called)
+
+    @patch.object(relations, 'configure_https')
+    @patch.object(relations, 'CONFIGS')
+    def test_config_changed_render_only(self, configs, configure_https):
+        self.config_changed_keys.return_value = set(['rabbit-vhost'])
+        relations.config_changed()
+        self.assertFalse(configure_https.called)
+        self.assertTrue(configs.write_all.called)
+        self.assertTrue(self.save_config_fingerprint.called)
+
+    @patch.object(relations, 'configure_https')
     @patch.object(relations, 'CONFIGS')
+    def test_config_changed_unrendered_keys(self, configs, configure_https):
+        self.config_changed_keys.return_value = set(
+            ['ceph-osd-replication-count'])
+        relations.config_changed()
+        self.assertFalse(configure_https.called)
+        self.assertFalse(configs.write_all.called)
+        self.assertFalse(self.relation_set.called)
+        self.assertTrue(self.save_config_fingerprint.called)
+
+    @patch.object(relations, 'CONFIGS')
+    def test_config_changed_hook_server(self, configs):
+        self.config_changed_keys.return_value = set(['hook-server'])
+        self.test_config.set('hook-server', True)
+        relations.config_changed()
+        self.hookserver.start.assert_called_with(relations.HOOK_SCRIPT)
+        self.assertFalse(configs.write_all.called)
+        self.test_config.set('hook-server', False)
+        relations.config_changed()
+        self.assertTrue(self.hookserver.stop.called)
+
+    @patch.object(relations, 'CONFIGS')
+    def test_config_changed_apt_keys(self, configs):
+        self.config_changed_keys.return_value = set(['apt-proxy'])
+        relations.config_changed()
+        self.configure_package_sources.assert_called_with('distro')
+        self.apt_update.assert_called_with(max_age=3600)
+        self.assertFalse(configs.write_all.called)
+
+    @patch.object(relations, 'ha_relation_joined')
+    @patch.object(relations, 'configure_https')
+    @patch.object(relations, 'CONFIGS')
+    def test_config_changed_ha_keys(self, configs, configure_https,
+                                    ha_relation_joined):
+        self.config_changed_keys.return_value = set(['vip_cidr'])
+        self.relation_ids.return_value = ['ha:0']
+        relations.config_changed()
+        self.assertFalse(configure_https.called)
+        self.assertFalse(configs.write_all.called)
+        ha_relation_joined.assert_called_with(relation_id='ha:0')
+
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
     def test_cluster_changed(self, configs):
         configs.complete_contexts = MagicMock()
         configs.complete_contexts.return_value = ['cluster']
@@ -342,10 +485,19 @@ class GlanceRelationTests(CharmTestCase):
                            call('/etc/haproxy/haproxy.cfg')],
                           configs.write.call_args_list)
 
-    @patch.object(relations, 'cluster_changed')
-    def test_upgrade_charm(self, cluster_changed):
+    @patch.object(relations, 'CONFIGS')
+    def test_upgrade_charm(self, configs):
+        self.hookserver.running.return_value = False
+        relations.upgrade_charm()
+        self.assertTrue(configs.write_all.called)
+        self.assertFalse(self.hookserver.start.called)
+
+    @patch.object(relations, 'CONFIGS')
+    def test_upgrade_charm_restarts_hook_server(self, configs):
+        self.hookserver.running.return_value = True
         relations.upgrade_charm()
-        cluster_changed.assert_called_with()
+        self.assertTrue(self.hookserver.stop.called)
+        self.hookserver.start.assert_called_with(relations.HOOK_SCRIPT)
 
     def test_ha_relation_joined(self):
         self.test_config.set('ha-bindiface', 'em0')
@@ -355,6 +507,7 @@ class GlanceRelationTests(CharmTestCase):
         self.test_config.set('vip_cidr', '24')
         relations.ha_relation_joined()
         args = {
+            'relation_id': None,
             'corosync_bindiface': 'em0',
             'corosync_mcastport': '8080',
             'init_services': {'res_glance_haproxy': 'haproxy'},
@@ -440,7 +593,7 @@ class GlanceRelationTests(CharmTestCase):
         relations.amqp_changed()
         self.juju_log.assert_called()
 
-    @patch.object(relations, 'CONFIGS')
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
     def test_amqp_changed_relation_data(self, configs):
         configs.complete_contexts = MagicMock()
         configs.complete_contexts.return_value = ['amqp']
@@ -468,7 +621,83 @@ class GlanceRelationTests(CharmTestCase):
         ks_joined.assert_called_with('identity:0')
         image_joined.assert_called_with('image:1')
 
+    @patch.object(relations, 'run_pending_restarts')
+    @patch.object(relations, 'relation_type')
+    def test_resume_restarts(self, relation_type, run_pending_restarts):
+        relation_type.return_value = 'amqp'
+        relations.resume_restarts()
+        self.assertFalse(run_pending_restarts.called)
+        self.load_state.return_value = {'token': '1.0',
+                                        'services': ['glance-api']}
+        relations.resume_restarts()
+        self.assertTrue(run_pending_restarts.called)
+
+    @patch.object(relations, 'run_pending_restarts')
+    @patch.object(relations, 'relation_type')
+    def test_resume_restarts_cluster_hook(self, relation_type,
+                                          run_pending_restarts):
+        relation_type.return_value = 'cluster'
+        relations.resume_restarts()
+        self.assertTrue(run_pending_restarts.called)
+
+    @patch.object(relations, 'relation_type')
     @patch.object(relations, 'CONFIGS')
-    def test_relation_broken(self, configs):
+    def test_relation_broken(self, configs, relation_type):
+        relation_type.return_value = None
         relations.relation_broken()
         self.assertTrue(configs.write_all.called)
+
+    @patch.object(relations, 'relation_type')
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
+    def test_relation_broken_ceph(self, configs, relation_type):
+        relation_type.return_value = 'ceph'
+        relations.relation_broken()
+        self.assertEquals([call('/etc/glance/glance-api.conf'),
+                           call('/etc/ceph/ceph.conf')],
+                          configs.write.call_args_list)
+
+    @patch.object(relations, 'relation_type')
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
+    def test_relation_broken_shared_db(self, configs, relation_type):
+        relation_type.return_value = 'shared-db'
+        relations.relation_broken()
+        self.assertEquals([call('/etc/glance/glance-registry.conf'),
+                           call('/etc/glance/glance-api.conf')],
+                          configs.write.call_args_list)
+
+    @patch.object(relations, 'relation_type')
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
+    def test_relation_broken_identity_service(self, configs, relation_type):
+        relation_type.return_value = 'identity-service'
+        relations.relation_broken()
+        self.assertEquals(
+            [call('/etc/glance/glance-registry.conf'),
+             call('/etc/glance/glance-api.conf'),
+             call('/etc/glance/glance-api-paste.ini'),
+             call('/etc/glance/glance-registry-paste.ini'),
+             call('/etc/haproxy/haproxy.cfg'),
+             call('/etc/apache2/sites-available/openstack_https_frontend'),
+             call('/etc/apache2/sites-available/'
+                  'openstack_https_frontend.conf')],
+            configs.write.call_args_list)
+
+    @patch.object(relations, 'relation_type')
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
+    def test_relation_broken_object_store(self, configs, relation_type):
+        relation_type.return_value = 'object-store'
+        relations.relation_broken()
+        self.assertEquals([call('/etc/glance/glance-api.conf')],
+                          configs.write.call_args_list)
+
+    @patch.object(relations, 'CONFIGS', new_callable=config_renderer)
+    def test_configure_https_writes_https_and_cluster_files(self, configs):
+        configs.complete_contexts.return_value = ['https']
+        self.relation_ids.return_value = []
+        relations.configure_https()
+        self.assertEquals(
+            [call('/etc/glance/glance-api.conf'),
+             call('/etc/haproxy/haproxy.cfg'),
+             call('/etc/apache2/sites-available/openstack_https_frontend'),
+             call('/etc/apache2/sites-available/'
+                  'openstack_https_frontend.conf')],
+            configs.write.call_args_list)
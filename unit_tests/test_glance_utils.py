@@ -6,6 +6,7 @@ import glance_utils as utils
 
 from test_utils import (
     CharmTestCase,
+    http_server,
 )
 
 TO_PATCH = [
@@ -21,7 +22,7 @@ TO_PATCH = [
     'templating',
     'apt_update',
     'apt_install',
-    'mkdir'
+    'configure_apt_proxy'
 ]
 
 
@@ -29,7 +30,7 @@ class TestGlanceUtils(CharmTestCase):
 
     def setUp(self):
         super(TestGlanceUtils, self).setUp(utils, TO_PATCH)
-        self.config.side_effect = self.test_config.get_all
+        self.config.side_effect = self.test_config.get
 
     @patch('subprocess.check_call')
     def test_migrate_database(self, check_call):
@@ -68,6 +69,17 @@ class TestGlanceUtils(CharmTestCase):
             )
         configs.register.assert_has_calls(calls, any_order=True)
 
+    @patch('os.path.exists')
+    def test_register_configs_render_workers(self, exists):
+        exists.return_value = False
+        self.get_os_codename_package.return_value = 'havana'
+        self.relation_ids.return_value = False
+        self.test_config.set('render-workers', 4)
+        utils.register_configs()
+        self.templating.OSConfigRenderer.assert_called_with(
+            templates_dir=utils.TEMPLATES, openstack_release='havana',
+            workers=4)
+
     @patch('os.path.exists')
     def test_register_configs_apache24(self, exists):
         exists.return_value = True
@@ -106,7 +118,6 @@ class TestGlanceUtils(CharmTestCase):
                      utils.CONFIG_FILES[conf]['hook_contexts'])
             )
         configs.register.assert_has_calls(calls, any_order=True)
-        self.mkdir.assert_called_with('/etc/ceph')
 
     def test_restart_map(self):
         ex_map = OrderedDict([
@@ -115,12 +126,97 @@ class TestGlanceUtils(CharmTestCase):
             (utils.GLANCE_API_PASTE_INI, ['glance-api']),
             (utils.GLANCE_REGISTRY_PASTE_INI, ['glance-registry']),
             (utils.CEPH_CONF, ['glance-api', 'glance-registry']),
-            (utils.HAPROXY_CONF, ['haproxy']),
-            (utils.HTTPS_APACHE_CONF, ['apache2']),
-            (utils.HTTPS_APACHE_24_CONF, ['apache2'])
+            (utils.HAPROXY_CONF, [('haproxy', 'handoff')]),
+            (utils.HTTPS_APACHE_CONF, [('apache2', 'graceful')]),
+            (utils.HTTPS_APACHE_24_CONF, [('apache2', 'graceful')])
         ])
         self.assertEquals(ex_map, utils.restart_map())
 
+    def test_relation_interfaces_are_provided(self):
+        provided = set()
+        for spec in utils.CONFIG_FILES.itervalues():
+            for context in spec['hook_contexts']:
+                provided.update(context.interfaces)
+        for interfaces in utils.RELATION_INTERFACES.itervalues():
+            self.assertTrue(set(interfaces) <= provided)
+
+    def test_lazy_configs_built_on_first_use(self):
+        factory = MagicMock()
+        configs = utils.LazyConfigs(factory)
+        self.assertFalse(factory.called)
+        configs.write_all()
+        configs.complete_contexts()
+        factory.assert_called_once_with()
+        self.assertTrue(factory.return_value.write_all.called)
+
+    def test_lazy_configs_declares_config_files(self):
+        with patch.object(utils, 'atomic_files', set()) as files:
+            factory = MagicMock()
+            utils.LazyConfigs(factory, utils.CONFIG_FILES)
+            self.assertEquals(files, set(utils.CONFIG_FILES))
+            self.assertFalse(factory.called)
+
+    def test_lazy_configs_reset(self):
+        factory = MagicMock()
+        configs = utils.LazyConfigs(factory)
+        configs.write_all()
+        configs.reset()
+        self.assertEquals(factory.call_count, 1)
+        configs.write_all()
+        self.assertEquals(factory.call_count, 2)
+
+    def test_mirror_available(self):
+        release = '/ubuntu-cloud/dists/precise-updates/havana/Release'
+        with http_server({release: 'Origin: Canonical'}) as (url, requested):
+            self.assertTrue(utils.mirror_available(url + '/ubuntu-cloud/',
+                                                   'cloud:precise-havana'))
+            self.assertFalse(utils.mirror_available(url + '/ubuntu-cloud',
+                                                    'cloud:precise-grizzly'))
+        self.assertEquals(requested[0], release)
+
+    def test_mirror_available_through_proxy(self):
+        mirror = 'http://mirror.example.com/ubuntu-cloud'
+        release = '/ubuntu-cloud/dists/precise-updates/havana/Release'
+        with http_server({release: 'Origin: Canonical'}) as (proxy, requested):
+            self.assertTrue(utils.mirror_available(mirror,
+                                                   'cloud:precise-havana',
+                                                   proxy=proxy))
+        self.assertEquals(requested,
+                          ['http://mirror.example.com' + release])
+
+    def test_mirror_available_not_cloud_archive(self):
+        self.assertTrue(utils.mirror_available('http://127.0.0.1:9',
+                                               'ppa:foo/bar'))
+
+    def test_configure_package_sources_mirror(self):
+        self.config.side_effect = self.test_config.get
+        self.test_config.set('apt-proxy', 'http://squid:3128')
+        url = 'http://mirror.example.com/ubuntu-cloud'
+        self.test_config.set('cloud-archive-mirror', url)
+        with patch.object(utils, 'mirror_available') as available:
+            available.return_value = True
+            utils.configure_package_sources('cloud:precise-havana')
+            available.assert_called_with(url, 'cloud:precise-havana',
+                                         'http://squid:3128')
+        self.configure_apt_proxy.assert_called_with('http://squid:3128')
+        self.configure_installation_source.assert_called_with(
+            'cloud:precise-havana', mirror=url)
+
+    def test_configure_package_sources_mirror_unavailable(self):
+        self.config.side_effect = self.test_config.get
+        with http_server({}) as (url, _):
+            self.test_config.set('cloud-archive-mirror', url)
+            utils.configure_package_sources('cloud:precise-havana')
+        self.configure_apt_proxy.assert_called_with('')
+        self.configure_installation_source.assert_called_with(
+            'cloud:precise-havana', mirror=None)
+
+    def test_configure_package_sources_no_mirror(self):
+        self.config.side_effect = self.test_config.get
+        utils.configure_package_sources('cloud:precise-havana')
+        self.configure_installation_source.assert_called_with(
+            'cloud:precise-havana', mirror=None)
+
     @patch.object(utils, 'migrate_database')
     def test_openstack_upgrade_leader(self, migrate):
         self.config.side_effect = None
@@ -144,3 +240,151 @@ class TestGlanceUtils(CharmTestCase):
         self.assertTrue(configs.write_all.called)
         configs.set_release.assert_called_with(openstack_release='havana')
         self.assertFalse(migrate.called)
+
+
+ROLLING_TO_PATCH = [
+    'config',
+    'log',
+    'load_state',
+    'save_state',
+    'save_state_on_success',
+    'local_unit',
+    'relation_ids',
+    'related_units',
+    'relation_get',
+    'relation_set',
+    'service_update',
+    'time',
+]
+
+
+class TestRollingRestarts(CharmTestCase):
+
+    def setUp(self):
+        super(TestRollingRestarts, self).setUp(utils, ROLLING_TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.state = {}
+        self.load_state.side_effect = \
+            lambda name, default=None: self.state.get(name, default)
+        self.save_state.side_effect = self.state.__setitem__
+        self.save_state_on_success.side_effect = self.state.__setitem__
+        self.local_unit.return_value = 'glance/0'
+        self.peers = {'glance/1': {}}
+        self.relation_ids.return_value = ['cluster:1']
+        self.related_units.side_effect = lambda rid: sorted(self.peers)
+        self.relation_get.side_effect = \
+            lambda attribute, rid, unit: self.peers[unit].get(attribute)
+        self.time.time.return_value = 1000.0
+
+    def pending(self, token='1000.000000'):
+        self.state['pending-restarts'] = {
+            'token': token, 'services': ['glance-api']}
+        self.state['restart-requested'] = token
+
+    def test_schedule_restarts_without_peers(self):
+        self.peers = {}
+        updates = OrderedDict([('glance-api', 'restart'),
+                               ('haproxy', 'handoff')])
+        self.assertEquals(utils.schedule_restarts(updates), updates)
+        self.assertFalse(self.relation_set.called)
+
+    def test_schedule_restarts_disabled(self):
+        self.test_config.set('restart-batch-size', 0)
+        updates = OrderedDict([('glance-api', 'restart')])
+        self.assertEquals(utils.schedule_restarts(updates), updates)
+
+    def test_schedule_restarts_queues_rolling_services(self):
+        updates = OrderedDict([('glance-api', 'restart'),
+                               ('glance-registry', 'restart'),
+                               ('haproxy', 'handoff')])
+        self.assertEquals(utils.schedule_restarts(updates),
+                          OrderedDict([('haproxy', 'handoff')]))
+        self.assertEquals(self.state['pending-restarts'],
+                          {'token': '1000.000000',
+                           'services': ['glance-api', 'glance-registry']})
+        self.relation_set.assert_called_with(
+            relation_id='cluster:1', **{'restart-request': '1000.000000'})
+        self.save_state_on_success.assert_called_with('restart-requested',
+                                                      '1000.000000')
+        self.assertFalse(self.service_update.called)
+
+    def test_run_pending_restarts_waits_for_acknowledgement(self):
+        self.pending()
+        utils.run_pending_restarts()
+        self.assertFalse(self.service_update.called)
+        self.relation_set.assert_called_with(
+            relation_id='cluster:1',
+            **{'restart-queue': 'glance/0=1000.000000'})
+
+    def test_run_pending_restarts_first_in_queue(self):
+        self.pending()
+        self.peers['glance/1'] = {'restart-queue': 'glance/0=1000.000000'}
+        utils.run_pending_restarts()
+        self.service_update.assert_called_with('glance-api', 'restart')
+        self.save_state_on_success.assert_any_call('pending-restarts', None)
+        self.assertEquals(self.state['pending-restarts'], None)
+        self.relation_set.assert_any_call(
+            relation_id='cluster:1', **{'restart-done': '1000.000000'})
+
+    def test_run_pending_restarts_peer_restarts_first(self):
+        self.pending()
+        self.peers['glance/1'] = {
+            'restart-request': '999.000000',
+            'restart-queue': 'glance/1=999.000000 glance/0=1000.000000'}
+        utils.run_pending_restarts()
+        self.assertFalse(self.service_update.called)
+        # until it is done
+        self.peers['glance/1']['restart-done'] = '999.000000'
+        utils.run_pending_restarts()
+        self.service_update.assert_called_with('glance-api', 'restart')
+
+    def test_run_pending_restarts_batch_size(self):
+        self.test_config.set('restart-batch-size', 2)
+        self.pending()
+        self.peers['glance/1'] = {
+            'restart-request': '999.000000',
+            'restart-queue': 'glance/1=999.000000 glance/0=1000.000000'}
+        utils.run_pending_restarts()
+        self.service_update.assert_called_with('glance-api', 'restart')
+
+    def test_run_pending_restarts_timeout(self):
+        self.pending()
+        self.time.time.return_value = 1000.0 + 601
+        utils.run_pending_restarts()
+        self.service_update.assert_called_with('glance-api', 'restart')
+
+    def test_run_pending_restarts_republishes_failed_request(self):
+        # the hook that requested the restart failed
+        self.pending()
+        del self.state['restart-requested']
+        utils.run_pending_restarts()
+        self.relation_set.assert_any_call(
+            relation_id='cluster:1', **{'restart-request': '1000.000000'})
+        self.assertEquals(self.state['restart-requested'], '1000.000000')
+        self.assertFalse(self.service_update.called)
+
+    def test_run_pending_restarts_without_peers(self):
+        self.pending()
+        self.peers = {}
+        utils.run_pending_restarts()
+        self.service_update.assert_called_with('glance-api', 'restart')
+        self.assertEquals(self.state['pending-restarts'], None)
+
+    def test_run_pending_restarts_malformed_peer_token(self):
+        self.pending()
+        self.peers['glance/1'] = {
+            'restart-request': 'bogus',
+            'restart-queue': 'glance/0=1000.000000'}
+        self.assertEquals(utils.restart_queue(),
+                          [('1000.000000', 'glance/0')])
+        utils.run_pending_restarts()
+        self.service_update.assert_called_with('glance-api', 'restart')
+
+    def test_run_pending_restarts_malformed_token(self):
+        self.pending(token='bogus')
+        utils.run_pending_restarts()
+        self.assertFalse(self.service_update.called)
+        self.assertEquals(self.state['pending-restarts']['token'],
+                          '1000.000000')
+        self.relation_set.assert_any_call(
+            relation_id='cluster:1', **{'restart-request': '1000.000000'})
@@ -0,0 +1,457 @@
+import os
+import json
+import atexit
+import shutil
+import tempfile
+import threading
+
+from mock import patch, call
+
+from charmhelpers.core import hookenv
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'subprocess',
+]
+
+ENV = {
+    'JUJU_UNIT_NAME': 'glance/0',
+    'JUJU_RELATION': 'shared-db',
+    'JUJU_RELATION_ID': 'shared-db:1',
+    'JUJU_REMOTE_UNIT': 'mysql/0',
+}
+
+RELATIONS = {
+    ('shared-db:1', 'mysql/0'): {'db_host': '10.0.0.2', 'password': 'pw'},
+    ('shared-db:1', 'glance/0'): {'database': 'glance'},
+}
+
+
+class HookenvTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(HookenvTestCase, self).setUp(hookenv, TO_PATCH)
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        _env = patch.dict(os.environ, ENV, CHARM_STATE_DIR=self.state_dir)
+        _env.start()
+        self.addCleanup(_env.stop)
+        hookenv.reset()
+        self.addCleanup(hookenv.reset)
+        self.relations = dict(RELATIONS)
+        self.config = {'region': 'RegionOne', 'debug': False}
+        self.subprocess.check_output.side_effect = self.hook_tool
+
+    def hook_tool(self, args):
+        if args[0] == 'config-get':
+            return json.dumps(self.config)
+        if args[0] == 'relation-get':
+            rid = args[args.index('-r') + 1] if '-r' in args else None
+            unit = args[-1] if args[-1] != '-' else None
+            return json.dumps(self.relations.get((rid, unit)))
+        raise AssertionError('unexpected hook tool %s' % args)
+
+    def tool_calls(self, tool):
+        return [c for c in self.subprocess.check_output.call_args_list
+                if c[0][0][0] == tool]
+
+
+class RelationSnapshotTests(HookenvTestCase):
+
+    def test_relation_get_uses_one_relation_get_per_unit(self):
+        self.assertEquals(hookenv.relation_get('db_host'), '10.0.0.2')
+        self.assertEquals(hookenv.relation_get('password'), 'pw')
+        self.assertEquals(hookenv.relation_get('missing'), None)
+        self.assertEquals(hookenv.relation_get(),
+                          {'db_host': '10.0.0.2', 'password': 'pw'})
+        self.assertEquals(self.tool_calls('relation-get'), [
+            call(['relation-get', '--format=json', '-r', 'shared-db:1', '-',
+                  'mysql/0'])])
+        self.assertEquals(hookenv.saved_calls, {'relation-get': 3})
+
+    def test_relation_get_snapshots_per_unit(self):
+        self.assertEquals(hookenv.relation_get('database', unit='glance/0'),
+                          'glance')
+        self.assertEquals(hookenv.relation_get('db_host'), '10.0.0.2')
+        self.assertEquals(len(self.tool_calls('relation-get')), 2)
+
+    def test_relation_get_returns_a_copy(self):
+        hookenv.relation_get()['db_host'] = 'changed'
+        self.assertEquals(hookenv.relation_get('db_host'), '10.0.0.2')
+
+    def test_relation_get_unknown_relation(self):
+        self.assertEquals(hookenv.relation_get('db_host', rid='shared-db:9',
+                                               unit='mysql/1'), None)
+        self.assertEquals(hookenv.relation_get(rid='shared-db:9',
+                                               unit='mysql/1'), None)
+        self.assertEquals(len(self.tool_calls('relation-get')), 1)
+
+    def test_flush_relation_refetches_local_settings(self):
+        hookenv.relation_get(unit='glance/0')
+        hookenv.relation_get()
+        hookenv.flush_relation('shared-db:1')
+        self.relations[('shared-db:1', 'glance/0')] = {'database': 'other'}
+        self.assertEquals(hookenv.relation_get('database', unit='glance/0'),
+                          'other')
+        # the remote unit's snapshot is kept
+        hookenv.relation_get()
+        self.assertEquals(len(self.tool_calls('relation-get')), 3)
+
+    def test_reset_forgets_snapshots(self):
+        hookenv.relation_get('db_host')
+        hookenv.reset()
+        self.relations[('shared-db:1', 'mysql/0')] = {'db_host': '10.0.0.3'}
+        self.assertEquals(hookenv.relation_get('db_host'), '10.0.0.3')
+
+
+class ConfigSnapshotTests(HookenvTestCase):
+
+    def test_config_uses_one_config_get(self):
+        self.assertEquals(hookenv.config('region'), 'RegionOne')
+        self.assertEquals(hookenv.config('missing'), None)
+        self.assertEquals(hookenv.config(), self.config)
+        self.assertEquals(self.tool_calls('config-get'), [
+            call(['config-get', '--format=json'])])
+        self.assertEquals(hookenv.saved_calls, {'config-get': 2})
+
+    def test_config_returns_a_copy(self):
+        hookenv.config()['region'] = 'changed'
+        self.assertEquals(hookenv.config('region'), 'RegionOne')
+
+    def test_config_changed_keys_without_fingerprint(self):
+        self.assertEquals(hookenv.config_changed_keys(),
+                          set(['region', 'debug']))
+
+    def test_config_changed_keys(self):
+        hookenv.save_config_fingerprint()
+        self.assertEquals(hookenv.config_changed_keys(), set())
+        hookenv.reset()
+        self.config = {'region': 'RegionTwo', 'vip': '10.0.0.100'}
+        self.assertEquals(hookenv.config_changed_keys(),
+                          set(['region', 'debug', 'vip']))
+
+
+class SaveStateTests(HookenvTestCase):
+
+    def test_save_state(self):
+        hookenv.save_state('doc', {'a': [1, 2]})
+        self.assertEquals(hookenv.load_state('doc'), {'a': [1, 2]})
+        self.assertEquals(os.listdir(self.state_dir), ['doc.json'])
+
+    def test_load_state_default(self):
+        self.assertEquals(hookenv.load_state('missing', {}), {})
+
+    def test_save_state_failure_keeps_old_state(self):
+        hookenv.save_state('doc', {'a': 1})
+        self.assertRaises(TypeError, hookenv.save_state, 'doc',
+                          {'a': object()})
+        self.assertEquals(hookenv.load_state('doc'), {'a': 1})
+        self.assertEquals(os.listdir(self.state_dir), ['doc.json'])
+
+
+class SaveStateOnSuccessTests(HookenvTestCase):
+
+    def run_hook(self, function):
+        hooks = hookenv.Hooks()
+        hooks.register('config-changed', function)
+        hooks.execute(['config-changed'])
+
+    def stored(self, name):
+        return os.path.exists(os.path.join(self.state_dir, name + '.json'))
+
+    def test_saved_when_hook_succeeds(self):
+        def hook():
+            hookenv.save_config_fingerprint()
+            self.assertFalse(self.stored('config-fingerprint'))
+            # read back within the hook
+            self.assertEquals(hookenv.config_changed_keys(), set())
+
+        self.run_hook(hook)
+        self.assertTrue(self.stored('config-fingerprint'))
+        self.assertEquals(hookenv.config_changed_keys(), set())
+
+    def test_saved_after_relation_settings(self):
+        def hook():
+            hookenv.relation_set(database='other')
+            hookenv.save_state_on_success('done', True)
+
+        self.subprocess.check_call.side_effect = \
+            lambda args: self.assertFalse(self.stored('done'))
+        self.run_hook(hook)
+        self.assertTrue(self.subprocess.check_call.called)
+        self.assertEquals(hookenv.load_state('done'), True)
+
+    def test_dropped_when_hook_fails(self):
+        def hook():
+            hookenv.save_config_fingerprint()
+            raise ValueError('hook failed')
+
+        self.assertRaises(ValueError, self.run_hook, hook)
+        self.assertFalse(self.stored('config-fingerprint'))
+        self.assertEquals(hookenv.config_changed_keys(),
+                          set(['region', 'debug']))
+
+    def test_dropped_when_relation_set_fails(self):
+        def hook():
+            hookenv.relation_set(database='other')
+            hookenv.save_state_on_success('done', True)
+
+        self.subprocess.check_call.side_effect = \
+            hookenv.CalledProcessError(1, 'relation-set')
+        self.assertRaises(hookenv.CalledProcessError, self.run_hook, hook)
+        self.assertEquals(hookenv.load_state('done'), None)
+
+    def test_save_state_replaces_queued(self):
+        def hook():
+            hookenv.save_state_on_success('done', False)
+            hookenv.save_state('done', True)
+            self.assertEquals(hookenv.load_state('done'), True)
+
+        self.run_hook(hook)
+        self.assertEquals(hookenv.load_state('done'), True)
+
+    def test_saved_at_once_outside_hooks(self):
+        hookenv.save_state_on_success('done', {'a': 1})
+        self.assertEquals(hookenv.load_state('done'), {'a': 1})
+
+
+class CachedTests(HookenvTestCase):
+
+    def test_cached(self):
+        calls = []
+
+        @hookenv.cached
+        def lookup(key):
+            calls.append(key)
+            return key.upper()
+
+        self.assertEquals(lookup('a'), 'A')
+        self.assertEquals(lookup('a'), 'A')
+        self.assertEquals(lookup(key='b'), 'B')
+        self.assertEquals(calls, ['a', 'b'])
+
+    def test_cached_unhashable_arguments(self):
+        calls = []
+
+        @hookenv.cached
+        def lookup(keys):
+            calls.append(keys)
+            return len(keys)
+
+        self.assertEquals(lookup(['a', 'b']), 2)
+        self.assertEquals(lookup(['a', 'b']), 2)
+        self.assertEquals(len(calls), 1)
+
+    def test_cached_calls_func_once_per_key_across_threads(self):
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        @hookenv.cached
+        def lookup(key):
+            calls.append(key)
+            started.set()
+            release.wait(5)
+            return key
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            lookup('a'))) for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEquals(calls, ['a'])
+        self.assertEquals(results, ['a'] * 4)
+
+    def test_flush_func(self):
+        calls = []
+
+        @hookenv.cached
+        def lookup(key):
+            calls.append(key)
+
+        @hookenv.cached
+        def other(key):
+            calls.append(key)
+
+        lookup('a')
+        other('b')
+        hookenv.flush_func(lookup)
+        lookup('a')
+        other('b')
+        self.assertEquals(calls, ['a', 'b', 'a'])
+
+    def test_flush_relation(self):
+        calls = []
+
+        @hookenv.cached
+        def lookup(key, rid=None):
+            calls.append((key, rid))
+
+        lookup('a', rid='shared-db:1')
+        lookup('a')
+        lookup('a', 'amqp:2')
+        hookenv.flush_relation('shared-db:1')
+        lookup('a', rid='shared-db:1')
+        lookup('a')
+        lookup('a', 'amqp:2')
+        # no rid defaults to the current relation
+        self.assertEquals(calls, [('a', 'shared-db:1'), ('a', None),
+                                  ('a', 'amqp:2'), ('a', 'shared-db:1'),
+                                  ('a', None)])
+
+    def test_flush_bumps_data_generation(self):
+        generation = hookenv.data_generation
+        hookenv.flush('relation_get')
+        self.assertEquals(hookenv.data_generation, generation + 1)
+
+
+class LogBufferTests(HookenvTestCase):
+
+    def setUp(self):
+        super(LogBufferTests, self).setUp()
+        self.addCleanup(hookenv.set_log_level, hookenv.log_level)
+        hookenv.set_log_level(hookenv.DEBUG)
+
+    def test_log_is_buffered(self):
+        hookenv.log('one')
+        hookenv.log('two', level=hookenv.DEBUG)
+        self.assertFalse(self.subprocess.call.called)
+        hookenv.log_flush()
+        self.assertEquals(self.subprocess.call.call_args_list, [
+            call(['juju-log', '-l', hookenv.INFO, 'one']),
+            call(['juju-log', '-l', hookenv.DEBUG, 'two'])])
+        self.assertEquals(hookenv.log_buffer, [])
+
+    def test_log_groups_messages_by_level(self):
+        hookenv.log('one')
+        hookenv.log('two')
+        hookenv.log_flush()
+        self.subprocess.call.assert_called_once_with(
+            ['juju-log', '-l', hookenv.INFO, 'one\ntwo'])
+
+    def test_warning_flushes_in_order(self):
+        hookenv.log('one')
+        hookenv.log('problem', level=hookenv.WARNING)
+        self.assertEquals(self.subprocess.call.call_args_list, [
+            call(['juju-log', '-l', hookenv.INFO, 'one']),
+            call(['juju-log', '-l', hookenv.WARNING, 'problem'])])
+
+    def test_log_level(self):
+        hookenv.set_log_level(hookenv.INFO)
+        hookenv.log('dropped', level=hookenv.DEBUG)
+        hookenv.log('kept')
+        self.assertEquals(hookenv.log_buffer, [(hookenv.INFO, 'kept')])
+
+    def test_captured_log(self):
+        with hookenv.captured_log() as messages:
+            hookenv.log('captured', level=hookenv.ERROR)
+        self.assertEquals(messages, [('captured', hookenv.ERROR)])
+        self.assertFalse(self.subprocess.call.called)
+
+    def test_flush_at_exit(self):
+        hookenv.log('one')
+        hookenv._log_flush_at_exit()
+        self.subprocess.call.assert_called_once_with(
+            ['juju-log', '-l', hookenv.INFO, 'one'])
+
+    def test_flush_at_exit_without_juju_log(self):
+        self.subprocess.call.side_effect = OSError
+        hookenv.log('one')
+        hookenv._log_flush_at_exit()
+
+    def test_flush_at_exit_is_registered(self):
+        self.assertIn(hookenv._log_flush_at_exit,
+                      [f for f, _, _ in atexit._exithandlers])
+
+
+class DeferredRelationSetTests(HookenvTestCase):
+
+    def setUp(self):
+        super(DeferredRelationSetTests, self).setUp()
+        hookenv.defer_relation_set()
+
+    def relation_sets(self):
+        return self.subprocess.check_call.call_args_list
+
+    def test_settings_are_merged_per_relation(self):
+        hookenv.relation_set(database='a', username='glance')
+        hookenv.relation_set(relation_settings={'database': 'b'})
+        hookenv.relation_set(relation_id='amqp:2', vhost='openstack')
+        self.assertFalse(self.subprocess.check_call.called)
+        hookenv.flush_relation_set()
+        self.assertEquals(self.relation_sets(), [
+            call(['relation-set', '-r', 'amqp:2', 'vhost=openstack']),
+            call(['relation-set', '-r', 'shared-db:1', 'username=glance',
+                  'database=b'])])
+
+    def test_queued_settings_are_read_back(self):
+        self.assertEquals(hookenv.relation_get('database', unit='glance/0'),
+                          'glance')
+        hookenv.relation_set(database='other', port=3306, hostname=None)
+        self.assertEquals(hookenv.relation_get(unit='glance/0'),
+                          {'database': 'other', 'port': '3306',
+                           'hostname': None})
+        # the remote unit's settings are unaffected
+        self.assertEquals(hookenv.relation_get('database'), None)
+        self.assertEquals(len(self.tool_calls('relation-get')), 2)
+
+    def test_published_values_are_left_out(self):
+        hookenv.relation_get(unit='glance/0')
+        hookenv.relation_set(database='glance', username='glance')
+        hookenv.flush_relation_set()
+        self.assertEquals(self.relation_sets(), [
+            call(['relation-set', '-r', 'shared-db:1', 'username=glance'])])
+        # compared with the snapshot read before relation_set
+        self.assertEquals(len(self.tool_calls('relation-get')), 1)
+
+    def test_nothing_written_when_all_published(self):
+        hookenv.relation_get(unit='glance/0')
+        hookenv.relation_set(database='glance')
+        hookenv.flush_relation_set()
+        self.assertFalse(self.subprocess.check_call.called)
+
+    def test_unread_settings_are_not_fetched(self):
+        hookenv.relation_set(database='glance')
+        hookenv.flush_relation_set()
+        self.assertEquals(self.tool_calls('relation-get'), [])
+        self.assertEquals(self.relation_sets(), [
+            call(['relation-set', '-r', 'shared-db:1', 'database=glance'])])
+
+    def test_flush_stops_queueing(self):
+        hookenv.flush_relation_set()
+        hookenv.relation_set(database='other')
+        self.assertEquals(self.relation_sets(), [
+            call(['relation-set', 'database=other'])])
+
+    def test_settings_dropped_when_hook_fails(self):
+        def hook():
+            hookenv.relation_set(database='other')
+            raise ValueError('hook failed')
+
+        hooks = hookenv.Hooks()
+        hooks.register('shared-db-relation-changed', hook)
+        self.assertRaises(ValueError, hooks.execute,
+                          ['shared-db-relation-changed'])
+        self.assertFalse(self.subprocess.check_call.called)
+        self.assertEquals(hookenv.pending_relation_settings, None)
+
+    def test_settings_written_after_hook(self):
+        ran = []
+
+        def hook():
+            hookenv.relation_set(database='other')
+            self.assertFalse(self.subprocess.check_call.called)
+
+        hooks = hookenv.Hooks()
+        hooks.register('shared-db-relation-changed', hook)
+        hooks.after(lambda: ran.append('after'))
+        hooks.execute(['shared-db-relation-changed'])
+        self.assertEquals(ran, ['after'])
+        self.assertEquals(self.relation_sets(), [
+            call(['relation-set', '-r', 'shared-db:1', 'database=other'])])
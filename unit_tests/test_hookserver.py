@@ -0,0 +1,156 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import unittest
+
+from mock import patch
+
+from charmhelpers.core import hookenv, hookserver, metrics, tracing
+
+
+class FakeHooks(object):
+    '''Hooks reporting what they saw through their exit status'''
+
+    def execute(self, args):
+        hook_name = os.path.basename(args[0])
+        if hook_name == 'exit-status':
+            sys.exit(int(os.environ['HOOK_STATUS']))
+        elif hook_name == 'log-level':
+            sys.exit(hookenv.LOG_LEVELS.index(hookenv.log_level))
+        elif hook_name == 'cached-entries':
+            sys.exit(len(hookenv.cache))
+        elif hook_name == 'diagnostics':
+            sys.exit((1 if tracing.enabled else 0) +
+                     (2 if metrics.textfile_dir else 0))
+        elif hook_name == 'cwd':
+            sys.exit(0 if os.getcwd() == os.environ['HOOK_CWD'] else 1)
+        elif hook_name == 'fails':
+            raise ValueError('hook failed')
+        raise hookenv.UnregisteredHookError(hook_name)
+
+
+class HookServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, hookserver.SOCKET_NAME)
+        _env = patch.dict(os.environ, {'CHARM_STATE_DIR': self.tmp})
+        _env.start()
+        self.addCleanup(_env.stop)
+        self.addCleanup(hookenv.reset)
+
+    def serve(self):
+        '''Run a hook server for FakeHooks in a child process'''
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                with open(os.devnull, 'w') as devnull:
+                    os.dup2(devnull.fileno(), 2)
+                hookserver.serve(FakeHooks(), path=self.path)
+                status = 0
+            finally:
+                os._exit(status)
+        self.addCleanup(self.kill, pid)
+        for _ in range(500):
+            if hookserver.running(self.path):
+                return pid
+            time.sleep(0.01)
+        self.fail('hook server did not start')
+
+    def kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+    def run_hook(self, hook_name, **env):
+        with patch.dict(os.environ, env):
+            return hookserver.run_client([hook_name], path=self.path)
+
+    def test_socket_path(self):
+        self.assertEquals(hookserver.socket_path(), self.path)
+
+    def test_client_without_server(self):
+        self.assertEquals(hookserver.run_client(['config-changed'],
+                                                path=self.path), None)
+        self.assertFalse(hookserver.running(self.path))
+
+    def test_client_with_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        self.assertEquals(hookserver.run_client(['config-changed'],
+                                                path=self.path), None)
+        self.assertFalse(hookserver.running(self.path))
+
+    def test_in_process_hooks(self):
+        self.serve()
+        for hook_name in hookserver.IN_PROCESS_HOOKS:
+            self.assertEquals(self.run_hook(hook_name), None)
+        self.assertEquals(hookserver.run_client(
+            ['glance_relations.py', hookserver.SERVE_ARG], path=self.path),
+            None)
+
+    def test_serve_replaces_stale_socket(self):
+        with open(self.path, 'w'):
+            pass
+        self.serve()
+        self.assertTrue(hookserver.running(self.path))
+
+    def test_hook_status_and_environment(self):
+        self.serve()
+        self.assertEquals(self.run_hook('exit-status', HOOK_STATUS='0'), 0)
+        self.assertEquals(self.run_hook('exit-status', HOOK_STATUS='3'), 3)
+        self.assertEquals(self.run_hook('cwd', HOOK_CWD=os.getcwd()), 0)
+
+    @patch.object(hookenv, 'log')
+    @patch.object(hookserver.traceback, 'print_exc')
+    def test_hook_failures(self, print_exc, log):
+        # patched in the server, which forks the hooks
+        self.serve()
+        self.assertEquals(self.run_hook('fails'), 1)
+        self.assertEquals(self.run_hook('unknown'), 0)
+
+    def test_log_level_read_per_hook(self):
+        self.serve()
+        self.assertEquals(self.run_hook('log-level',
+                                        CHARM_LOG_LEVEL=hookenv.ERROR),
+                          hookenv.LOG_LEVELS.index(hookenv.ERROR))
+        with patch.dict(os.environ):
+            os.environ.pop('CHARM_LOG_LEVEL', None)
+            self.assertEquals(self.run_hook('log-level'),
+                              hookenv.LOG_LEVELS.index(hookenv.DEBUG))
+
+    def test_diagnostics_read_per_hook(self):
+        self.serve()
+        self.assertEquals(self.run_hook('diagnostics'), 0)
+        self.assertEquals(self.run_hook('diagnostics', CHARM_HOOK_TRACE='1',
+                                        CHARM_METRICS_DIR=self.tmp), 3)
+        self.assertEquals(self.run_hook('diagnostics'), 0)
+
+    def test_hook_state_is_reset(self):
+        hookenv.cache['stale'] = True
+        request = {'argv': ['cached-entries'], 'env': dict(os.environ),
+                   'cwd': os.getcwd(), 'pid': os.getpid()}
+        self.assertEquals(hookserver._run_hook(FakeHooks(), request, None), 0)
+        # setup runs after the reset
+        self.assertEquals(hookserver._run_hook(
+            FakeHooks(), request,
+            lambda: hookenv.cache.update(fresh=True)), 1)
+        self.assertEquals(hookenv.cache, {'stale': True})
+
+    def test_stop(self):
+        pid = self.serve()
+        hookserver.stop(self.path)
+        self.assertEquals(os.waitpid(pid, 0), (pid, 0))
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(hookserver.running(self.path))
+        # stopping again is harmless
+        hookserver.stop(self.path)
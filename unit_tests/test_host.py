@@ -0,0 +1,148 @@
+import os
+import shutil
+import tempfile
+
+from collections import OrderedDict
+from mock import call, patch
+
+from charmhelpers.core import host
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'log',
+    'service',
+    'subprocess',
+]
+
+
+class ServiceStrategyTests(CharmTestCase):
+
+    def setUp(self):
+        super(ServiceStrategyTests, self).setUp(host, TO_PATCH)
+        host.metrics.counters.clear()
+        self.addCleanup(host.metrics.counters.clear)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.pidfile = os.path.join(self.tmp, 'haproxy.pid')
+
+    def test_service_updates(self):
+        restart_map = OrderedDict([
+            ('/etc/a.conf', ['api', ('haproxy', host.HANDOFF)]),
+            ('/etc/b.conf', [('apache2', host.GRACEFUL), 'haproxy']),
+            ('/etc/c.conf', ['other']),
+        ])
+        self.assertEquals(
+            host.service_updates(restart_map, ['/etc/a.conf']),
+            OrderedDict([('api', host.RESTART),
+                         ('haproxy', host.HANDOFF)]))
+        # restarting wins over reloading
+        self.assertEquals(
+            host.service_updates(restart_map,
+                                 ['/etc/b.conf', '/etc/a.conf']),
+            OrderedDict([('api', host.RESTART),
+                         ('haproxy', host.RESTART),
+                         ('apache2', host.GRACEFUL)]))
+
+    def test_service_update_reload(self):
+        self.service.return_value = True
+        self.assertTrue(host.service_update('glance-api', host.RELOAD))
+        self.service.assert_called_once_with('reload', 'glance-api')
+        self.assertEquals(host.metrics.counters, {'service_reloads': 1})
+
+    def test_service_update_falls_back_to_restart(self):
+        self.subprocess.call.return_value = 1
+        self.service.return_value = True
+        self.assertTrue(host.service_update('apache2', host.GRACEFUL))
+        self.subprocess.call.assert_called_once_with(['apache2ctl',
+                                                      'graceful'])
+        self.service.assert_called_once_with('restart', 'apache2')
+
+    def test_haproxy_handoff(self):
+        with open(self.pidfile, 'w') as f:
+            f.write('101\n102\n')
+        self.subprocess.call.return_value = 0
+        self.assertTrue(host.haproxy_handoff(pidfile=self.pidfile))
+        self.assertEquals(self.subprocess.call.call_args_list, [
+            call(['haproxy', '-c', '-q', '-f', host.HAPROXY_CONF]),
+            call(['haproxy', '-f', host.HAPROXY_CONF, '-p', self.pidfile,
+                  '-D', '-sf', '101', '102'])])
+
+    def test_haproxy_handoff_not_running(self):
+        self.assertFalse(host.haproxy_handoff(pidfile=self.pidfile))
+        self.assertFalse(self.subprocess.call.called)
+
+    def test_haproxy_handoff_invalid_config(self):
+        with open(self.pidfile, 'w') as f:
+            f.write('101\n')
+        self.subprocess.call.return_value = 1
+        self.assertFalse(host.haproxy_handoff(pidfile=self.pidfile))
+        self.assertEquals(self.subprocess.call.call_count, 1)
+
+
+class RestartOnChangeTests(CharmTestCase):
+
+    def setUp(self):
+        super(RestartOnChangeTests, self).setUp(host, TO_PATCH)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.conf = os.path.join(self.tmp, 'a.conf')
+        self.other = os.path.join(self.tmp, 'b.conf')
+        for path in (self.conf, self.other):
+            with open(path, 'w') as f:
+                f.write('old')
+        self.restart_map = OrderedDict([(self.conf, ['api']),
+                                        (self.other, ['registry'])])
+        self.service.return_value = True
+
+    def run_hook(self, hook):
+        host.restart_on_change(self.restart_map)(hook)()
+
+    def test_atomic_write(self):
+        self.run_hook(lambda: host.atomic_write(self.conf, 'new'))
+        self.service.assert_called_once_with('restart', 'api')
+
+    def test_atomic_write_unchanged(self):
+        self.run_hook(lambda: host.atomic_write(self.conf, 'old'))
+        self.assertFalse(self.service.called)
+
+    def test_other_writes(self):
+        def hook():
+            with open(self.other, 'w') as f:
+                f.write('new')
+
+        self.run_hook(hook)
+        self.service.assert_called_once_with('restart', 'registry')
+
+    def test_other_writes_unchanged(self):
+        def hook():
+            with open(self.other, 'w') as f:
+                f.write('old')
+
+        self.run_hook(hook)
+        self.assertFalse(self.service.called)
+
+    def test_removed_file(self):
+        self.run_hook(lambda: os.unlink(self.conf))
+        self.service.assert_called_once_with('restart', 'api')
+
+    def test_atomic_files_not_checksummed(self):
+        with patch.object(host, 'atomic_files', set([self.conf])):
+            with patch.object(host, 'file_hash',
+                              side_effect=host.file_hash) as file_hash:
+                self.run_hook(lambda: host.atomic_write(self.conf, 'new'))
+        self.assertEquals(file_hash.call_args_list,
+                          [call(self.other), call(self.other)])
+        self.service.assert_called_once_with('restart', 'api')
+
+    def test_schedule(self):
+        scheduled = []
+
+        def schedule(updates):
+            scheduled.append(updates)
+            return {}
+
+        host.restart_on_change(self.restart_map, schedule=schedule)(
+            lambda: host.atomic_write(self.conf, 'new'))()
+        self.assertEquals(scheduled, [{'api': host.RESTART}])
+        self.assertFalse(self.service.called)
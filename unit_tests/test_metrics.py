@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from charmhelpers.core import metrics
+
+SAMPLE = {
+    'duration_seconds': 0.3,
+    'cpu_seconds': 0.2,
+    'max_rss_bytes': 1024,
+    'subprocesses': 4,
+    'config_writes': 2,
+    'service_restarts': 1,
+    'service_reloads': 3,
+    'timestamp_seconds': 1000.0,
+}
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(metrics.counters.clear)
+
+    def test_increment(self):
+        metrics.increment('config_writes')
+        metrics.increment('config_writes', 2)
+        self.assertEquals(metrics.counters, {'config_writes': 3})
+
+    def test_hook_timer(self):
+        subprocesses = [3]
+        metrics.increment('config_writes')
+        timer = metrics.HookTimer(lambda: subprocesses[0])
+        # counters are per hook execution
+        self.assertEquals(metrics.counters, {})
+        metrics.increment('config_writes', 2)
+        metrics.increment('service_restarts')
+        metrics.increment('service_reloads', 2)
+        subprocesses[0] = 7
+        sample = timer.sample()
+        self.assertEquals(sample['subprocesses'], 4)
+        self.assertEquals(sample['config_writes'], 2)
+        self.assertEquals(sample['service_restarts'], 1)
+        self.assertEquals(sample['service_reloads'], 2)
+        self.assertTrue(sample['duration_seconds'] >= 0)
+        self.assertEquals(set(sample), set(name for name, _ in
+                                           metrics.GAUGES))
+
+    def test_update(self):
+        state = metrics.update({}, 'install', SAMPLE)
+        state = metrics.update(state, 'install', dict(SAMPLE,
+                                                      duration_seconds=7),
+                               failed=True)
+        hook = state['install']
+        self.assertEquals(hook['runs'], 2)
+        self.assertEquals(hook['failures'], 1)
+        self.assertEquals(hook['last']['duration_seconds'], 7)
+        histogram = hook['duration_seconds']
+        self.assertEquals(histogram['count'], 2)
+        self.assertEquals(histogram['sum'], 7.3)
+        # buckets are cumulative: 0.3 <= 0.5 and both <= 10
+        bucket = dict(zip(metrics.BUCKETS, histogram['buckets']))
+        self.assertEquals((bucket[0.25], bucket[0.5], bucket[5], bucket[10]),
+                          (0, 1, 1, 2))
+
+    def test_render(self):
+        state = metrics.update({}, 'config-changed', SAMPLE)
+        text = metrics.render(state, 'glance/0')
+        labels = '{unit="glance/0",hook="config-changed"}'
+        self.assertIn('# TYPE juju_hook_duration_seconds histogram\n', text)
+        self.assertIn('juju_hook_duration_seconds_bucket{unit="glance/0",'
+                      'hook="config-changed",le="0.5"} 1\n', text)
+        self.assertIn('juju_hook_duration_seconds_count%s 1\n' % labels,
+                      text)
+        self.assertIn('juju_hook_last_service_restarts%s 1\n' % labels, text)
+        self.assertIn('juju_hook_last_config_writes%s 2\n' % labels, text)
+        self.assertIn('juju_hook_last_service_reloads%s 3\n' % labels, text)
+        self.assertIn('juju_hook_failures_total%s 0\n' % labels, text)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_render_state_without_newer_gauges(self):
+        sample = dict(SAMPLE)
+        del sample['service_reloads']
+        text = metrics.render(metrics.update({}, 'install', sample),
+                              'glance/0')
+        self.assertIn('juju_hook_last_service_reloads{unit="glance/0",'
+                      'hook="install"} 0\n', text)
+
+    def test_write_textfile(self):
+        directory = os.path.join(self.tmp, 'textfile')
+        path = metrics.write_textfile(directory, 'glance/0', 'text\n')
+        self.assertEquals(path, os.path.join(directory,
+                                             'juju-hooks-glance-0.prom'))
+        with open(path) as f:
+            self.assertEquals(f.read(), 'text\n')
+        self.assertEquals(os.listdir(directory), ['juju-hooks-glance-0.prom'])
@@ -0,0 +1,164 @@
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from charmhelpers.core import hookenv
+from charmhelpers.contrib.openstack import templating
+from charmhelpers.contrib.openstack.context import OSContextGenerator
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'apt_install',
+    'log',
+]
+
+
+class RelationContext(OSContextGenerator):
+    '''Returns the settings of a unit on a relation'''
+    interfaces = ['test']
+
+    def __init__(self, rid, unit):
+        self.rid = rid
+        self.unit = unit
+
+    def __call__(self):
+        return {'settings': hookenv.relation_get(rid=self.rid,
+                                                 unit=self.unit)}
+
+
+class TemplatingTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(TemplatingTestCase, self).setUp(templating, TO_PATCH)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        _env = patch.dict(os.environ, {'CHARM_STATE_DIR': self.tmp,
+                                       'JUJU_UNIT_NAME': 'glance/0'})
+        _env.start()
+        self.addCleanup(_env.stop)
+        hookenv.reset()
+        self.addCleanup(hookenv.reset)
+        self.settings = {}
+        _snapshot = patch.object(hookenv, 'relation_snapshot',
+                                 side_effect=lambda rid, unit: self.settings)
+        _snapshot.start()
+        self.addCleanup(_snapshot.stop)
+
+    def renderer(self, contexts):
+        configs = templating.OSConfigRenderer(self.tmp, 'havana')
+        configs.register('/etc/test.conf', contexts)
+        return configs
+
+
+class ContextFingerprintTests(TemplatingTestCase):
+
+    def test_fingerprint_follows_relation_data(self):
+        configs = self.renderer([RelationContext('test:1', 'remote/0')])
+        self.settings = {'a': '1'}
+        first = configs.context_fingerprint(['test'])
+        self.assertEquals(configs.context_fingerprint(['test']), first)
+        hookenv.flush_func(hookenv.relation_get)
+        self.settings = {'a': '2'}
+        self.assertNotEquals(configs.context_fingerprint(['test']), first)
+
+    def test_fingerprint_ignores_dict_order(self):
+        configs = self.renderer([RelationContext('test:1', 'remote/0')])
+        # 'a' and 'i' share a hash slot, so these iterate in the order
+        # they were inserted in
+        self.settings = dict([('a', '1'), ('i', '2')])
+        first = configs.context_fingerprint(['test'])
+        hookenv.flush_func(hookenv.relation_get)
+        self.settings = dict([('i', '2'), ('a', '1')])
+        self.assertNotEquals(self.settings.keys(), ['a', 'i'])
+        self.assertEquals(configs.context_fingerprint(['test']), first)
+
+
+class RegisterTests(TemplatingTestCase):
+
+    def test_registered_configs_are_atomic_files(self):
+        with patch.object(templating, 'atomic_files', set()) as files:
+            self.renderer([RelationContext('test:1', 'remote/0')])
+            self.assertEquals(files, set(['/etc/test.conf']))
+
+
+class MutatingContext(OSContextGenerator):
+    '''Like SharedDBContext, fills in attributes when called'''
+    interfaces = ['test']
+    calls = 0
+
+    def __init__(self, database=None):
+        self.database = database
+
+    def __call__(self):
+        MutatingContext.calls += 1
+        self.database = self.database or 'glance'
+        return {'database': self.database}
+
+
+class ContextCacheTests(TemplatingTestCase):
+
+    def setUp(self):
+        super(ContextCacheTests, self).setUp()
+        MutatingContext.calls = 0
+        self.cache = templating.ContextCache()
+
+    def test_generator_runs_once_per_hook(self):
+        context = MutatingContext()
+        for _ in range(3):
+            self.assertEquals(self.cache(context), {'database': 'glance'})
+        self.assertEquals(MutatingContext.calls, 1)
+        self.assertEquals((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_results_shared_by_equal_generators(self):
+        self.cache(MutatingContext())
+        self.cache(MutatingContext())
+        self.assertTrue(MutatingContext() in self.cache)
+        self.cache(MutatingContext(database='other'))
+        self.assertEquals(MutatingContext.calls, 2)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_results_shared_across_templates(self):
+        configs = self.renderer([MutatingContext()])
+        configs.register('/etc/other.conf', [MutatingContext()])
+        with patch.object(templating, 'context_cache', self.cache):
+            configs.templates['/etc/test.conf'].context()
+            configs.templates['/etc/other.conf'].context()
+            configs.complete_contexts()
+        self.assertEquals(MutatingContext.calls, 1)
+
+    def test_other_callables_keyed_by_identity(self):
+        calls = []
+
+        def context():
+            calls.append(1)
+            return {}
+
+        self.cache(context)
+        self.cache(context)
+        self.cache(lambda: calls.append(2))
+        self.assertEquals(calls, [1, 2])
+
+    def test_flush_invalidates_results(self):
+        context = MutatingContext()
+        self.cache(context)
+        hookenv.flush_func(hookenv.config)
+        self.assertFalse(context in self.cache)
+        self.cache(context)
+        self.assertEquals(MutatingContext.calls, 2)
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_reset_invalidates_results(self):
+        self.cache(MutatingContext())
+        hookenv.reset()
+        self.cache(MutatingContext())
+        self.assertEquals(MutatingContext.calls, 2)
+
+    def test_apply_once_per_result(self):
+        context = MutatingContext()
+        with patch.object(MutatingContext, 'apply') as apply:
+            self.cache.apply(context)
+            self.cache.apply(MutatingContext())
+            apply.assert_called_once_with({'database': 'glance'})
@@ -2,6 +2,9 @@ import logging
 import unittest
 import os
 import yaml
+import hashlib
+import threading
+import BaseHTTPServer
 
 from contextlib import contextmanager
 from mock import patch, MagicMock
@@ -119,3 +122,49 @@ def patch_open():
 
     with patch('__builtin__.open', stub_open):
         yield mock_open, mock_file
+
+
+@contextmanager
+def http_server(content):
+    '''Serve content, a dict of path to body, on a local port.  Range
+    requests of the form bytes=N- are honoured, unless their If-Range
+    differs from the body's ETag, a digest of it.
+
+    Yields the server's base url and the list of paths requested, which are
+    absolute urls when the server is used as a proxy.'''
+    requested = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            path = self.path.split('://', 1)[-1]
+            path = path[path.index('/'):] if '://' in self.path else path
+            if path in content:
+                body = content[path]
+                etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+                start = self.headers.get('Range', 'bytes=0-')[6:-1]
+                if self.headers.get('If-Range', etag) != etag:
+                    start = '0'
+                if int(start) >= len(body):
+                    self.send_error(416)
+                    return
+                self.send_response(206 if int(start) else 200)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body[int(start):])
+            else:
+                self.send_error(404)
+
+        def log_message(self, *args):
+            pass
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever,
+                              kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d' % server.server_port, requested
+    finally:
+        server.shutdown()
+        server.server_close()